@@ -15,6 +15,13 @@ import re
 import sys
 import csv
 import io
+import selectors
+import asyncio
+import multiprocessing
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 
 # Version 1 :
 #   - 1st version, used for NPI
@@ -82,10 +89,127 @@ import io
 #	  i.e. after a raise ValueError("cmd timeout")
 #	  (avoids waisting time since the DUT will not answer anymore)
 #
-# TODO: log the list of enabled slots
 # Globals
 software_version = "Co2 jig software version 19 (20140106_1700)"
 logger = None
+
+class DeviceCache:
+	'''USB serial ports and FTDI devices of the jig, enumerated once and saved into a file.
+	   The saved devices are used as long as the USB device nodes directories are not modified
+	   (checked with their mtime), so that the slow USB enumeration is skipped at the next start.
+	   Serial ports are found by USB serial number or by USB path (location)'''
+	__watched_dirs = ('/dev/serial/by-id', '/dev/bus/usb')	# Linux only: without them, devices are always enumerated
+	
+	def __init__(self, filename = 'device_cache.dat'):
+		self.__filename = filename
+		self.__ftdi_sns = None		# list of FTDI serial numbers (string); None: not loaded yet
+		self.__serial_ports = None	# list of (device, serial number, location) tuples
+		self.__enumerated = False	# True if the devices come from an enumeration, not from the file
+		
+	def getFtdiSerialNumbers(self):
+		'''Return the list of the FTDI devices serial numbers (list of string)'''
+		self.__load()
+		return self.__ftdi_sns
+	
+	def findSerialPort(self, key):
+		'''Return the device name of the serial port with USB serial number or USB location key.
+		   The devices are enumerated again if key is not in the saved devices'''
+		self.__load()
+		if not self.__enumerated and self.__findSerialPort(key) is None:
+			self.invalidate()
+			self.__load()
+		device = self.__findSerialPort(key)
+		if device is None:
+			raise ValueError("Serial port <%s> not found" % key)
+		return device
+	
+	def invalidate(self):
+		'''Forget the saved devices (ex: a saved device can't be opened): they are enumerated at the next use'''
+		logger.info("Invalidate device cache <%s>" % self.__filename)
+		self.__ftdi_sns = None
+		self.__serial_ports = None
+		if os.path.isfile(self.__filename):
+			os.remove(self.__filename)
+	
+	def __findSerialPort(self, key):
+		for device, serial_number, location in self.__serial_ports:
+			if key in (serial_number, location):
+				return device
+		return None
+		
+	def __load(self):
+		if self.__ftdi_sns is not None:
+			return
+		signature = self.__signature()
+		if signature is not None and os.path.isfile(self.__filename):
+			try:
+				if self.__loadFromFile(signature):
+					return
+			except ValueError as e:
+				logger.info(str(e))
+		self.__enumerate()
+		if signature is not None:
+			self.__saveToFile(signature)
+	
+	def __enumerate(self):
+		time_start = time()
+		self.__ftdi_sns = [bytes.decode(dev[2]) for dev in pylibftdi.Driver().list_devices()]
+		self.__serial_ports = [(port.device, port.serial_number, port.location) for port in serial.tools.list_ports.comports()]
+		self.__enumerated = True
+		logger.info("Enumerated %d FTDI devices and %d serial ports in %d ms" % (
+				len(self.__ftdi_sns), len(self.__serial_ports), (time() - time_start) * 1000))
+	
+	def __signature(self):
+		'''Return the mtimes of the USB device nodes directories (string),
+		   or None if none of them exists'''
+		mtimes = list()
+		for dirname in self.__watched_dirs:
+			if not os.path.isdir(dirname):
+				mtimes.append('%s:-' % dirname)
+				continue
+			dirnames = [dirname] + [os.path.join(dirname, name) for name in sorted(os.listdir(dirname))]
+			mtimes.extend(['%s:%d' % (name, os.stat(name).st_mtime_ns) for name in dirnames if os.path.isdir(name)])
+		if len(mtimes) == len([mtime for mtime in mtimes if mtime.endswith(':-')]):
+			return None
+		return ';'.join(mtimes)
+	
+	def __saveToFile(self, signature):
+		file = open(self.__filename, 'w')
+		file.write("signature %s\n" % signature)
+		for ftdi_sn in self.__ftdi_sns:
+			file.write("ftdi %s\n" % ftdi_sn)
+		for device, serial_number, location in self.__serial_ports:
+			file.write("serial %s %s %s\n" % (device, serial_number or '-', location or '-'))
+		file.close()
+	
+	def __loadFromFile(self, signature):
+		'''Return False if the saved devices are outdated'''
+		line_re = re.compile('^(signature|ftdi|serial) (\\S+)(?: (\\S+) (\\S+))?$')
+		ftdi_sns = list()
+		serial_ports = list()
+		file = open(self.__filename, 'r')
+		lines = file.read().splitlines()
+		file.close()
+		if not lines or not lines[0].startswith('signature '):
+			raise ValueError("%s: Invalid file format" % self.__filename)
+		for line in lines:
+			res = line_re.match(line)
+			if not res:
+				raise ValueError("%s: Invalid file format" % self.__filename)
+			if res.group(1) == 'signature':
+				if res.group(2) != signature:
+					logger.info("Device cache <%s> outdated" % self.__filename)
+					return False
+			elif res.group(1) == 'ftdi':
+				ftdi_sns.append(res.group(2))
+			elif res.group(3) is not None:
+				serial_ports.append(tuple([res.group(2)] + [None if value == '-' else value for value in res.group(3, 4)]))
+			else:
+				raise ValueError("%s: Invalid file format" % self.__filename)
+		self.__ftdi_sns = ftdi_sns
+		self.__serial_ports = serial_ports
+		self.__enumerated = False
+		return True
 	
 class Relay:
 	def __init__(self, id, name):
@@ -115,21 +239,34 @@ class RelayBoard:
 			relay_pump_pwr,
 			relay_gas_air)
 
-	def __init__(self, ftdi_sn = None):
+	def __init__(self, ftdi_sn = None, device_cache = None):
+		'''device_cache : (DeviceCache) used to find the FTDI of the relay board if ftdi_sn is None'''
 		if (ftdi_sn == None):
 			# Find the FTDI of the relay board automatically
-			dev_list = pylibftdi.Driver().list_devices()			
-			if len(dev_list) != 1:
-				# Found none or more than 1 device matching...
-				raise ValueError('Found %d relay board(s)' % len(dev_list))
-			ftdi_sn = bytes.decode(dev_list[0][2]) 
-			# or "ftdi_sn = dev_list[0][2].decode()" 
-			
-		logger.info("Open relayboard device S/N <%s>" % ftdi_sn)
-		self.__ftdi = pylibftdi.BitBangDevice(ftdi_sn)
+			if device_cache is None:
+				device_cache = DeviceCache()
+			try:
+				self.__ftdi = self.__open(self.__findFtdi(device_cache))
+			except pylibftdi.FtdiError:
+				# The saved devices may be outdated
+				device_cache.invalidate()
+				self.__ftdi = self.__open(self.__findFtdi(device_cache))
+		else:
+			self.__ftdi = self.__open(ftdi_sn)
 		self.__ftdi.direction = 0xFF		# All I/O are outputs
 		#self.__ftdi.port = 0x00		# All relay OFF		
 
+	def __findFtdi(self, device_cache):
+		ftdi_sns = device_cache.getFtdiSerialNumbers()
+		if len(ftdi_sns) != 1:
+			# Found none or more than 1 device matching...
+			raise ValueError('Found %d relay board(s)' % len(ftdi_sns))
+		return ftdi_sns[0]
+	
+	def __open(self, ftdi_sn):
+		logger.info("Open relayboard device S/N <%s>" % ftdi_sn)
+		return pylibftdi.BitBangDevice(ftdi_sn)
+
 	def setRelay(self, relay, on):
 		state = "On" if on else "Off"
 		logger.info("Set relay <%s> %s" % (relay.name, state))
@@ -226,44 +363,168 @@ class CalSettings:
 	fan_postinject_time_ms = 5000
 
 class CmdResult:
-	def __init__(self, rc, data):
+	def __init__(self, rc, data, errors = None):
 		'''rc : (int) cmd return code
-		   data : (dict) key = value result'''
+		   data : (dict) key = value result
+		   errors : (dict) key = error message, for the values which could not be converted'''
 		if type(rc) is not int:
 			raise ValueError('rc is not a int')
 		if type(data) is not dict:
 			raise ValueError('data is not a dict')
 		self.rc = rc
 		self.data = data
+		self.errors = errors if errors is not None else dict()
 	
 	@staticmethod
-	def parse(string):
-		rc = -1
-		data = dict()
-		lines = string.splitlines()
+	def parse(string, cmd = ""):
+		return CmdResult.parseLines(string.splitlines(), cmd)
+	
+	@staticmethod
+	def parseLines(lines, cmd = ""):
+		'''lines : (list of string) lines of the cmd reply
+		   cmd : (string) cmd which was sent, to select the value types'''
+		parser = CmdResultParser(cmd)
 		for line in lines:
-			keyval = line.split('=', 1)
-			if(len(keyval) == 2):
-				data[keyval[0]] = keyval[1]
-		#logger.debug(data)
+			parser.feedLine(line)
+		return parser.result()
+
+def parse_mac(value):
+	'''value : (string) MAC address, ex: "00:80:e1:00:00:01"'''
+	if not re.match('^[0-9A-Fa-f]{2}(:[0-9A-Fa-f]{2})+$', value):
+		raise ValueError("invalid MAC address")
+	return value
+
+class CmdResultParser:
+	'''Streaming parser of a DUT cmd reply.
+	   The "key=value" lines are parsed as soon as they are framed, and the values
+	   are converted according to the schema of the cmd. The other values are kept as strings.
+	   rc is available as soon as its line has been received'''
+	schemas = {
+		'probe'		: {'mac' : parse_mac},
+		'co2 verif'	: {'co2_ppm_verif' : int},
+		}
+	
+	def __init__(self, cmd = ""):
+		'''cmd : (string) cmd which was sent'''
+		self.rc = None			# cmd return code, None until received
+		self.data = dict()
+		self.errors = dict()
+		self.__schema = CmdResultParser.schemaFor(cmd)
+	
+	@staticmethod
+	def schemaFor(cmd):
+		'''Return the schema of the longest cmd name matching the beginning of cmd'''
+		schema_name = None
+		for name in CmdResultParser.schemas:
+			if (cmd == name) or cmd.startswith(name + ' '):
+				if (schema_name == None) or len(name) > len(schema_name):
+					schema_name = name
+		if schema_name == None:
+			return dict()
+		return CmdResultParser.schemas[schema_name]
+	
+	def feedLine(self, line):
+		'''line : (string) line of the cmd reply'''
+		keyval = line.split('=', 1)
+		if(len(keyval) != 2):
+			return
+		(key, value) = keyval
 		
 		# Parse cmd "rc=xxx"
-		if data.has_key('rc'):
-			rc = int(data['rc'])
-			del data['rc']
-			
-		#logger.debug("rc=%s" % rc)
-		return CmdResult(rc, data)
+		if key == 'rc':
+			convert = int
+		else:
+			convert = self.__schema.get(key)
+		if convert:
+			try:
+				value = convert(value)
+			except ValueError:
+				self.errors[key] = "invalid value <%s>" % value
+				return
 		
+		if key == 'rc':
+			self.rc = value
+		else:
+			self.data[key] = value
+	
+	def result(self):
+		rc = self.rc if self.rc is not None else -1
+		return CmdResult(rc, self.data, self.errors)
+
+class DutFramer:
+	'''Incremental framing of a DUT shell reply.
+	   Received bytes are appended to a bytearray holding the current incomplete line.
+	   Only the new bytes are scanned for CR line breaks (plus a few previous bytes for
+	   the shell prompt), and each line is decoded once, when it is complete.
+	   So the cost of a chunk does not depend on how much the DUT has already sent.'''
+	prompt = b'shell>'
+	
+	def __init__(self):
+		self.reset()
+	
+	def reset(self):
+		self.__buffer = bytearray()	# Current incomplete line
+		self.__prompt_found = False
+	
+	def feed(self, chunk):
+		'''chunk : (bytes-like) bytes received from the DUT UART
+		   Return the list of the new complete lines (list of string)'''
+		buffer = self.__buffer
+		scan_pos = len(buffer)
+		buffer += chunk
+		
+		# The prompt may have been cut between the previous chunk and this one
+		if not self.__prompt_found:
+			prompt_scan_pos = max(0, scan_pos - (len(self.prompt) - 1))
+			self.__prompt_found = (buffer.find(self.prompt, prompt_scan_pos) != -1)
+		
+		# Replace non-ascii characters with '?' because we sometimes receive - because of a bad uart connection ? -
+		# non-ascii characters from the DUT
+		new_lines = list()
+		line_start = 0
+		cr_pos = buffer.find(b'\r', scan_pos)
+		while cr_pos != -1:
+			new_lines.append(buffer[line_start:cr_pos].decode('ascii', 'replace').strip('\r\n'))
+			line_start = cr_pos + 1
+			cr_pos = buffer.find(b'\r', line_start)
+		if line_start > 0:
+			del buffer[:line_start]
+		return new_lines
+	
+	def promptFound(self):
+		return self.__prompt_found
+	
+	def tail(self):
+		'''Return the current incomplete line (string), i.e. the prompt line once the reply is complete'''
+		return self.__buffer.decode('ascii', 'replace').strip('\r\n')
 		
 
 class Dut:
+	tx_byte_delay_s = 0.001		# The DUT shell needs the cmd bytes to be sent slowly
+	__boot_nudge_ms = 1000		# Send an empty cmd to a booting DUT silent for longer, to get a prompt...
+	__boot_nudge_lost_ms = 3000	# ... unless the previous one is not answered yet, and sent less than 3 s ago
+	__boot_quiet_ms = 100		# After the boot prompt, the DUT output is drained until it is quiet for 100 ms...
+	__boot_drain_max_ms = 1000	# ... for up to 1 s
+	
 	def __init__(self, name, uart_name):
 		self.__name = name
+		self.__uart_name = uart_name
 		self.__mac = None
 		self.__uart = serial.Serial()
 		self.__logfile = None
-		self.__backlog = bytes()
+		self.__backlog = bytearray()
+		self.__rx_pending = bytearray()	# bytes received while sending a cmd, for the next rxBegin()
+		self.__rx_framer = DutFramer()
+		self.__rx_parser = CmdResultParser()
+		self.__tx_cmd = ""		# Last cmd sent, selects the types of the reply values
+		self.__tx_end_time = time()	# Time at which the last cmd was sent
+		self.__rx_time_ms = None	# Response time of the last cmd reply
+		self.__rx_last_time = time()	# Time at which the last bytes were received
+		self.__rx_buffer = bytearray(512)	# UART bytes are read into this buffer, and processed from slices of it
+		self.__rx_view = memoryview(self.__rx_buffer)
+		self.__tx_echo = False		# echo flow control
+		self.__tx_nb_sent = 0		# Number of bytes of the current cmd sent...
+		self.__tx_nb_echoed = 0		# ... and echoed back by the DUT shell
 		self.__pass = None		# Pass/Fail status (tristate: None, True, False)
 		self.__failure_reason = None	# reason of failure if __pass = False
 		
@@ -289,12 +550,10 @@ class Dut:
 
 	def log(self, uart_bytes):
 		# Strip "\n" to avoid "doubled" carriage returns
-		# For Bytes type, must add [b'']
-		stripped_uart_bytes = uart_bytes.replace(b'\n', b'')
 		if(self.__logfile):
-			self.__logfile.write(stripped_uart_bytes)
+			write_without_lf(self.__logfile.write, uart_bytes)
 		else:
-			self.__backlog += stripped_uart_bytes
+			write_without_lf(self.__backlog.extend, uart_bytes)
 		
 	def getName(self):
 		return self.__name
@@ -302,6 +561,17 @@ class Dut:
 	def getMac(self):
 		return self.__mac
 		
+	def getUartName(self):
+		return self.__uart_name
+		
+	def getShardState(self):
+		'''Return the state of the DUT updated by the cmd exchanges (tuple), to mirror a DUT
+		   handled by a shard worker process into the main process (see setShardState())'''
+		return (self.__mac, self.__tx_end_time, self.__rx_time_ms, self.__rx_last_time)
+	
+	def setShardState(self, state):
+		(self.__mac, self.__tx_end_time, self.__rx_time_ms, self.__rx_last_time) = state
+		
 	def setPass(self, ok, failure_reason = None):
 		if (self.__pass != None) and (ok != self.__pass):
 			msg = 'Attempting to set dut <%s> to %s but dut alreay set to  %s ' % (
@@ -324,18 +594,30 @@ class Dut:
 	def getPass(self):
 		return self.__pass
 	
-	def open(self):
+	def open(self, boot_timeout_ms = None, boot_abort = None):
+		'''boot_timeout_ms : if not None, the DUT has just been powered on:
+		                    wait up to boot_timeout_ms for its shell to be ready before probing it
+		   boot_abort : see waitBoot()'''
 		# Open UART
 		self.__uart.open()
 		self.__uart.flushInput()
+		del self.__rx_pending[:]
+		self.__rx_last_time = time()
+		
+		if boot_timeout_ms is not None:
+			self.waitBoot(boot_timeout_ms, boot_abort)
 		
 		# Get DUT MAC address
 		self.sendCmd("")
+		self.getResult(1000)	# Sync on the shell prompt, before probing
 		self.sendCmd("probe")
 		probeRes = self.getResult(1000)
 		if(probeRes.rc != 0):
 			logger.warn("Probing <%s> failed, rc=%d !" % (self.__name, probeRes.rc))
 			raise ValueError("Probing <%s> failed !" % self.__name)
+		if 'mac' not in probeRes.data:
+			logger.warn("Probing <%s> failed, mac %s !" % (self.__name, probeRes.errors.get('mac', "missing")))
+			raise ValueError("Probing <%s> failed !" % self.__name)
 		decorated_mac = probeRes.data['mac']
 		mac = decorated_mac.replace(":", "")
 		
@@ -356,62 +638,469 @@ class Dut:
 #		return self.__uart.isOpen()
 
 	def sendCmd(self, cmd):
-		logger.debug("Dut <%s> TX :" % self.__name)
-		logger.debug("\t%s" % cmd)
+		self.txBegin(cmd)
 		#self.__uart.flushInput()
 		# Workaround : the byte should be sent slowly...
 		#self.__uart.write("%s\r" % cmd)
 		for byte in cmd + '\r':
-			self.__uart.write(byte.encode())
-			sleep(0.001)
+			self.txByte(byte)
+			Dut.txWait([self])
+		self.txEnd()
+	
+	def txBegin(self, cmd):
+		'''Start sending cmd (the bytes are then sent with txByte())'''
+		self.__tx_cmd = cmd
+		self.__tx_nb_sent = 0
+		self.__tx_nb_echoed = 0
+		logger.debug("Dut <%s> TX :" % self.__name)
+		logger.debug("\t%s" % cmd)
+	
+	def txEnd(self):
+		'''The cmd has been sent: start counting the response time'''
+		self.__tx_end_time = time()
+	
+	def txByte(self, byte):
+		'''byte : (string) single character to send to the DUT, without any delay'''
+		self.__uart.write(byte.encode())
+		self.__tx_nb_sent += 1
+	
+	def setTxEcho(self, enabled):
+		'''Enable the echo flow control: the next cmd byte is sent as soon as the
+		   DUT shell has echoed the previous one, instead of waiting tx_byte_delay_s'''
+		self.__tx_echo = enabled
+	
+	def txEchoed(self):
+		'''Return True if the DUT shell has echoed all the bytes sent so far.
+		   The echoed bytes are counted, not matched: a late echo of the previous byte
+		   must not be taken for the echo of the same character sent again.
+		   The bytes read are kept, and processed as the beginning of the cmd reply'''
+		chunk = self.readAvailable()
+		self.__rx_pending += chunk
+		self.__tx_nb_echoed += len(chunk)
+		return self.__tx_nb_echoed >= self.__tx_nb_sent
+	
+	@staticmethod
+	def txWait(duts):
+		'''Wait before sending the next byte to duts:
+		   until all duts have echoed the bytes sent (echo flow control), or tx_byte_delay_s elapsed'''
+		if not all(dut.__tx_echo for dut in duts):
+			sleep(Dut.tx_byte_delay_s)
+			return
+		# Fall back to the fixed delay if a DUT does not echo in time
+		deadline = time() + Dut.tx_byte_delay_s
+		waiting = list(duts)
+		while waiting and time() < deadline:
+			waiting = [dut for dut in waiting if not dut.txEchoed()]
 	
 	def getResult(self, timeout_ms):
-		text = ""
-		text_pos = 0
 		time_start = time()
-		logger.debug("Dut <%s> RX :" % self.__name)
-		logger.debug("-----------------------------")
-		while True:
-			chunk = self.__uart.read(512)
+		prompt_found = self.rxBegin()
+		while not prompt_found:
+			# Read what is already received, or wait (up to the UART timeout) for at least 1 byte:
+			# don't wait for a full buffer, the prompt is often in a short chunk
+			size = max(1, min(self.__uart.inWaiting(), len(self.__rx_buffer)))
+			chunk = self.__rx_view[:self.__uart.readinto(self.__rx_view[:size])]
 			elapsed_time = (time() - time_start) * 1000
 			#logger.debug("elapsed time = %d" % elapsed_time)
-			self.log(chunk)
-			# Do we need to decode/encode !?
-			# Replace non-ascii characters with '?' because we sometimes receive - because of a bad uart connection ? -
-			# non-ascii characters from the DUT
-			text += chunk.decode('ascii', 'replace')
-			
-			
-			# Display board RX in logs, in "realtime"
-			while True:
-				cr_pos = text.find("\r", text_pos)
-				if cr_pos == -1:
-					break;
-				stripped = text[text_pos:cr_pos].rstrip('\r\n')
-				if len(stripped) > 0:
-					logger.debug("  %s" % stripped)
-				text_pos = cr_pos + 1
 			
 			# Return on shell prompt, or timeout
-			if (text.find('shell>') != -1):
-				logger.debug("-->prompt found")
+			prompt_found = self.rxFeed(chunk)
+			if prompt_found:
 				break
 			if (elapsed_time > timeout_ms):
 				logger.debug("-->timeout: %d ms", elapsed_time)
 				raise ValueError("cmd timeout")
 				break
+		
+		logger.debug("-->prompt found")
+		return self.rxEnd()
+	
+	def waitBoot(self, timeout_ms, abort = None):
+		'''Wait for the end of the DUT boot, i.e. the shell prompt.
+		   The boot banner goes to the DUT log backlog, like any other received bytes.
+		   An empty cmd is sent when the DUT stays silent, in case the prompt was printed before the UART was opened.
+		   Its prompt may come after the boot prompt: the DUT output is drained once booted, so that
+		   the next cmd does not take it for its reply
+		   abort : if not None, function returning True to stop waiting before timeout_ms'''
+		logger.debug("Dut <%s>: wait for boot" % self.__name)
+		time_start = time()
+		nudge_time = None
+		prompt_found = self.rxBegin()
+		while not prompt_found:
+			size = max(1, min(self.__uart.inWaiting(), len(self.__rx_buffer)))
+			chunk = self.__rx_view[:self.__uart.readinto(self.__rx_view[:size])]
+			prompt_found = self.rxFeed(chunk)
+			if prompt_found:
+				break
 			
+			now_time = time()
+			if ((now_time - time_start) * 1000 > timeout_ms) or (abort and abort()):
+				logger.debug("-->boot timeout: %d ms", (now_time - time_start) * 1000)
+				raise ValueError("Boot timeout on <%s>" % self.__name)
+			# One nudge at a time: the previous one must have been answered (or be lost)
+			nudge_allowed = (nudge_time is None) or (self.__rx_last_time > nudge_time) or (
+					(now_time - nudge_time) * 1000 > self.__boot_nudge_lost_ms)
+			if (self.getSilenceTime() > self.__boot_nudge_ms) and nudge_allowed:
+				nudge_time = now_time
+				self.sendCmd("")
+				prompt_found = self.rxFeed(self.__rx_pending)
+				del self.__rx_pending[:]
+		
+		logger.debug("Dut <%s>: booted in %d ms" % (self.__name, (time() - time_start) * 1000))
+		self.rxEnd()
+		self.__drain(self.__boot_quiet_ms, self.__boot_drain_max_ms)
+	
+	def __drain(self, quiet_ms, timeout_ms):
+		'''Log the bytes received until the DUT is quiet for quiet_ms (up to timeout_ms), then drop
+		   the bytes left, ex: the prompt of a boot nudge answered after the boot prompt'''
+		time_start = time()
+		quiet_start = time_start
+		while ((time() - quiet_start) * 1000 < quiet_ms) and ((time() - time_start) * 1000 < timeout_ms):
+			chunk = self.readAvailable()
+			if len(chunk) > 0:
+				self.log(chunk)
+				quiet_start = time()
+			else:
+				sleep(0.01)
+		self.__uart.flushInput()
+		del self.__rx_pending[:]
+	
+	async def send(self, cmd):
+		'''asyncio flavour of sendCmd()'''
+		# The bytes are paced with sleeps of 1 ms, which is below the resolution of
+		# the event loop timers on Windows: keep the paced write in a worker thread
+		await asyncio.get_running_loop().run_in_executor(None, self.sendCmd, cmd)
+	
+	async def result(self, timeout_ms):
+		'''asyncio flavour of getResult()'''
+		loop = asyncio.get_running_loop()
+		prompt = loop.create_future()
+		
+		def on_readable():
+			if prompt.done():
+				return
+			chunk = self.readAvailable()
+			if len(chunk) == 0:
+				# Readable but nothing to read: the UART is gone (USB unplugged ?)
+				prompt.set_exception(ValueError("uart error"))
+			elif self.rxFeed(chunk):
+				prompt.set_result(True)
+		
+		try:
+			fd = self.fileno()
+			loop.add_reader(fd, on_readable)
+		except (OSError, ValueError, NotImplementedError):
+			# No file descriptor for this UART (Windows COM port), or no reader support
+			# in this event loop: fall back to the blocking read loop in a worker thread
+			return await loop.run_in_executor(None, self.getResult, timeout_ms)
+		# on_readable() is only called once this coroutine yields to the event loop
+		if self.rxBegin():
+			prompt.set_result(True)
+		try:
+			await asyncio.wait_for(prompt, timeout_ms / 1000.0)
+		except asyncio.TimeoutError:
+			logger.debug("-->timeout: %d ms", timeout_ms)
+			raise ValueError("cmd timeout")
+		finally:
+			loop.remove_reader(fd)
+		logger.debug("-->prompt found")
+		return self.rxEnd()
+	
+	def fileno(self):
+		'''Return the file descriptor of the DUT UART (POSIX only)'''
+		return self.__uart.fileno()
+	
+	def readAvailable(self):
+		'''Read the bytes already received by the DUT UART (up to 512 bytes), without blocking
+		   Return a memoryview on the receive buffer, valid until the next read'''
+		size = min(self.__uart.inWaiting(), len(self.__rx_buffer))
+		return self.__rx_view[:self.__uart.readinto(self.__rx_view[:size])]
+	
+	def rxBegin(self):
+		'''Start receiving the reply of a command.
+		   The reply is then fed with rxFeed(), and parsed by rxEnd()
+		   Return True if the shell prompt has already been received while sending the cmd'''
+		self.__rx_framer.reset()
+		self.__rx_parser = CmdResultParser(self.__tx_cmd)
+		logger.debug("Dut <%s> RX :" % self.__name)
+		logger.debug("-----------------------------")
+		prompt_found = self.rxFeed(self.__rx_pending)
+		del self.__rx_pending[:]
+		return prompt_found
+	
+	def rxFeed(self, chunk):
+		'''chunk : (bytes-like) bytes received from the DUT UART
+		   Return True when the shell prompt has been received'''
+		if len(chunk) > 0:
+			self.__rx_last_time = time()
+		self.log(chunk)
+		
+		# Display board RX in logs, in "realtime"
+		for line in self.__rx_framer.feed(chunk):
+			if len(line) > 0:
+				logger.debug("  %s: %s" % (self.__name, line))
+			self.__rx_parser.feedLine(line)
+		
+		return self.__rx_framer.promptFound()
+	
+	def rxEnd(self):
+		'''Return the CmdResult of the reply received since rxBegin()'''
+		framer = self.__rx_framer
+		
 		# Flush Display RX in logs
-		stripped = text[text_pos:].rstrip('\r\n')
-		if len(stripped) > 0:
-			logger.debug("  %s" % stripped)	
-		
-		#for line in text.splitlines():
-		#	stripped = line.rstrip('\r\n')
-		#	if len(stripped) > 0:
-		#		logger.debug("  %s" % stripped)
+		tail = framer.tail()
+		if len(tail) > 0:
+			logger.debug("  %s: %s" % (self.__name, tail))
+		
 		logger.debug("-----------------------------")
-		return CmdResult.parse(text)
+		self.__rx_time_ms = (time() - self.__tx_end_time) * 1000
+		parser = self.__rx_parser
+		parser.feedLine(tail)
+		for key, error in parser.errors.items():
+			logger.warn("Dut <%s>: invalid value for <%s> (%s)" % (self.__name, key, error))
+		return parser.result()
+	
+	def getSilenceTime(self):
+		'''Return the time (ms) since the DUT sent its last bytes'''
+		return (time() - self.__rx_last_time) * 1000
+	
+	def getTxEndTime(self):
+		'''Return the time (time()) at which the last cmd was sent: the response time is counted from it'''
+		return self.__tx_end_time
+	
+	def getRxTime(self):
+		'''Return the response time (ms) of the last cmd reply'''
+		return self.__rx_time_ms
+	
+	def rxRc(self):
+		'''Return the return code of the reply being received, or None if not received yet'''
+		return self.__rx_parser.rc
+
+class DutReactor:
+	'''Collect the replies of several DUTs from a single thread.
+	   All the DUT UARTs are watched by a single select() loop, and the received bytes
+	   are fed to the reply framing of each DUT, instead of polling each UART
+	   with its own blocking read.
+	   Requires UARTs with a file descriptor (POSIX serial ports)'''
+	def __init__(self):
+		self.__selector = selectors.DefaultSelector()
+	
+	def collect(self, duts, timeouts_ms):
+		'''Wait for the reply of all duts.
+		   timeouts_ms : list of timeouts (ms), one per dut
+		   Return a list of (CmdResult, None) or (None, error_reason) tuples, in the same order as duts'''
+		selector = self.__selector
+		replies = dict()
+		time_start = time()
+		deadlines = dict()
+		for dut, timeout_ms in zip(duts, timeouts_ms):
+			deadlines[dut] = time_start + timeout_ms / 1000.0
+		for dut in duts:
+			if dut.rxBegin():
+				replies[dut] = (dut.rxEnd(), None)
+			else:
+				selector.register(dut.fileno(), selectors.EVENT_READ, dut)
+		try:
+			while len(replies) < len(duts):
+				now = time()
+				for key in list(selector.get_map().values()):
+					dut = key.data
+					if now >= deadlines[dut]:
+						logger.debug("Dut <%s> -->timeout: %d ms" % (dut.getName(), (now - time_start) * 1000))
+						selector.unregister(key.fd)
+						replies[dut] = (None, "cmd timeout")
+				if len(replies) == len(duts):
+					break
+				next_deadline = min([deadlines[key.data] for key in selector.get_map().values()])
+				for key, events in selector.select(next_deadline - now):
+					dut = key.data
+					chunk = dut.readAvailable()
+					if len(chunk) == 0:
+						# Readable but nothing to read: the UART is gone (USB unplugged ?)
+						selector.unregister(key.fd)
+						replies[dut] = (None, "uart error")
+					elif dut.rxFeed(chunk):
+						logger.debug("Dut <%s> -->prompt found" % dut.getName())
+						selector.unregister(key.fd)
+						replies[dut] = (dut.rxEnd(), None)
+		finally:
+			for key in list(selector.get_map().values()):
+				selector.unregister(key.fd)
+		return [replies[dut] for dut in duts]
+
+class DutLatencyTracker:
+	'''Response times of the DUT cmds, per cmd verb (ex: "co2 calib") and per slot.
+	   The timeout of a cmd is derived from a high percentile of the recorded response times,
+	   plus a margin. The timeout given by the caller is the upper bound.'''
+	__nb_sample_max = 50		# Response times kept per cmd verb and slot
+	__nb_sample_min = 5		# Response times needed to derive a timeout
+	__percentile = 0.95
+	__margin_ratio = 0.5		# timeout = percentile * (1 + margin_ratio) + margin_ms
+	__margin_ms = 1000
+	
+	def __init__(self):
+		self.__times = dict()	# (slot, verb) -> list of response times (ms)
+	
+	@staticmethod
+	def verb(cmd):
+		'''Return cmd without its numeric arguments, ex: "co2 calib" for "co2 calib 100 252 ..."'''
+		words = list()
+		for word in cmd.split():
+			if re.match('^[-+.0-9]', word):
+				break
+			words.append(word)
+		return " ".join(words)
+	
+	def record(self, slot, cmd, time_ms):
+		times = self.__times.setdefault((slot, self.verb(cmd)), list())
+		times.append(time_ms)
+		del times[:-self.__nb_sample_max]
+	
+	def timeout(self, slot, cmd, timeout_max_ms):
+		'''Return the timeout (ms) of cmd for slot, at most timeout_max_ms'''
+		verb = self.verb(cmd)
+		times = self.__times.get((slot, verb), list())
+		if len(times) < self.__nb_sample_min:
+			# Not enough history for this slot: use the history of all the slots
+			times = list()
+			for (times_slot, times_verb), slot_times in self.__times.items():
+				if times_verb == verb:
+					times += slot_times
+		if len(times) < self.__nb_sample_min:
+			return timeout_max_ms
+		times = sorted(times)
+		percentile_ms = times[min(len(times) - 1, int(len(times) * self.__percentile))]
+		timeout_ms = percentile_ms * (1 + self.__margin_ratio) + self.__margin_ms
+		return min(timeout_max_ms, int(timeout_ms))
+	
+	def saveToFile(self, filename = 'dut_latency.dat'):
+		file = open(filename, 'w')
+		for (slot, verb), times in sorted(self.__times.items()):
+			for time_ms in times:
+				file.write("%s %d %s\n" % (slot, time_ms, verb))
+		file.close()
+		logger.info("Saved DUT response times into file <%s>" % filename)
+	
+	def loadFromFile(self, filename = 'dut_latency.dat'):
+		times = dict()
+		line_re = re.compile('^(\\S+) ([0-9]+) (.*)$')
+		file = open(filename, 'r')
+		for line in file.readlines():
+			res = line_re.match(line.rstrip('\n'))
+			if not res:
+				raise ValueError('%s: Invalid file format' % filename)
+			times.setdefault((res.group(1), res.group(3)), list()).append(int(res.group(2)))
+		file.close()
+		self.__times = times
+		logger.info("Loaded DUT response times from file <%s> (%d cmd verbs x slots)" % (filename, len(times)))
+
+class DutShardPool:
+	'''Split the DUTs of a DutSet into worker processes (shards), each one handling the UARTs
+	   of its slots with its own DutSet, when a single process can't keep up with the UART rate
+	   of all the slots.
+	   The main process DutSet keeps Dut objects mirroring the DUTs of the workers
+	   (see Dut.getShardState()), and the cmds are sent to all the shards at the same time'''
+	
+	def __init__(self, duts, nb_shards, rx_mode, tx_echo):
+		self.__duts = dict([(dut.getName(), dut) for dut in duts])
+		self.__shard_of = dict()	# shard index, by slot name
+		self.__shards = list()		# (Process, Connection) per shard
+		nb_shards = min(nb_shards, len(duts))
+		for index in range(nb_shards):
+			shard_duts = duts[index::nb_shards]
+			slots = [(dut.getName(), dut.getUartName()) for dut in shard_duts]
+			(conn, worker_conn) = multiprocessing.Pipe()
+			process = multiprocessing.Process(target = dut_shard_worker, name = "dut_shard%d" % index,
+					args = (worker_conn, index, slots, rx_mode, tx_echo))
+			process.daemon = True
+			process.start()
+			worker_conn.close()
+			self.__shards.append((process, conn))
+			for dut in shard_duts:
+				self.__shard_of[dut.getName()] = index
+			logger.info("DUT shard %d: slots <%s>" % (index, "> <".join([name for name, uart_name in slots])))
+	
+	def openDuts(self, duts, boot_timeout_ms, boot_spread_ms):
+		'''See DutSet.openDuts().
+		   boot_spread_ms applies to each shard independently'''
+		return self.__request(duts, 'open', (boot_timeout_ms, boot_spread_ms))
+	
+	def exchange(self, duts, cmd, timeouts_ms):
+		'''See DutSet.exchange()'''
+		return self.__request(duts, 'exchange', (cmd,), timeouts_ms)
+	
+	def runSequences(self, duts, cmds, timeouts_ms):
+		'''See DutSet.runSequences()'''
+		return self.__request(duts, 'sequences', (cmds,), timeouts_ms)
+	
+	def close(self):
+		for process, conn in self.__shards:
+			try:
+				conn.send(('close', None, None, None))
+				conn.recv()
+			except (EOFError, OSError):
+				pass
+			conn.close()
+			process.join(5)
+		self.__shards = list()
+	
+	def __request(self, duts, op, args, per_dut_args = None):
+		'''Send op to the shards of duts at the same time, then wait for all of them.
+		   per_dut_args : list of arguments, one per dut, or None
+		   Return the list of the replies of the workers, in the same order as duts'''
+		if per_dut_args is None:
+			per_dut_args = [None] * len(duts)
+		requests = dict()	# (slot names, per dut args), by shard index
+		for dut, dut_args in zip(duts, per_dut_args):
+			(names, shard_args) = requests.setdefault(self.__shard_of[dut.getName()], (list(), list()))
+			names.append(dut.getName())
+			shard_args.append(dut_args)
+		for index, (names, shard_args) in requests.items():
+			self.__shards[index][1].send((op, names, args, shard_args))
+		replies = dict()
+		for index, (names, shard_args) in requests.items():
+			try:
+				(error, shard_replies, states) = self.__shards[index][1].recv()
+			except EOFError:
+				raise ValueError("DUT shard %d: worker process died" % index)
+			if error is not None:
+				raise ValueError("DUT shard %d: %s" % (index, error))
+			for name, reply, state in zip(names, shard_replies, states):
+				self.__duts[name].setShardState(state)
+				replies[name] = reply
+		return [replies[dut.getName()] for dut in duts]
+
+def dut_shard_worker(conn, index, slots, rx_mode, tx_echo):
+	'''Main function of the worker process of the DUT shard index (see DutShardPool)
+	   slots : list of (slot name, UART device) of the shard'''
+	if logger is None:
+		# Process not forked from the main one: log into a file of its own
+		init_logger('co2jig_shard%d.log' % index)
+	duts = tuple([Dut(name, uart_name) for name, uart_name in slots])
+	dut_set = DutSet(None, rx_mode, tx_echo, duts = duts)
+	duts_by_name = dict([(dut.getName(), dut) for dut in duts])
+	while True:
+		(op, names, args, shard_args) = conn.recv()
+		if op == 'close':
+			dut_set.close()
+			conn.send(None)
+			break
+		shard_duts = [duts_by_name[name] for name in names]
+		try:
+			if op == 'open':
+				replies = dut_set.openDuts(shard_duts, *args)
+			elif op == 'exchange':
+				replies = dut_set.exchange(shard_duts, args[0], shard_args)
+			elif op == 'sequences':
+				replies = dut_set.runSequences(shard_duts, args[0], shard_args)
+			else:
+				raise ValueError("Invalid op <%s>" % op)
+		except Exception:
+			logger.error(traceback.format_exc())
+			conn.send((traceback.format_exc().splitlines()[-1], None, None))
+			continue
+		conn.send((None, replies, [dut.getShardState() for dut in shard_duts]))
+	conn.close()
 
 class DutSetResult:
 	def __init__(self, dut, cmd_result):
@@ -419,6 +1108,7 @@ class DutSetResult:
 		    cmd_result	: (class CmdResult)'''
 		self.dut = dut
 		self.cmd_result = cmd_result
+		self.ref_window = None	# (mean ppm, spread ppm, nb samples) of the co2 meter during the cmd, if recorded
 		
 class DutSet:
 	__all_duts = (	Dut("slot1", "com101"),
@@ -441,14 +1131,145 @@ class DutSet:
 		
 	__excluded_duts = list()
 	
-	def __init__(self, nb_slots):
-		self.__duts = self.__all_duts[0:nb_slots]
+	__heartbeat_cmd_timeout_ms = 5000	# Check the DUTs are alive before the cmds with a longer timeout...
+	__heartbeat_silence_ms = 20000		# ... and when a DUT has been silent for longer
+	__heartbeat_timeout_ms = 1000		# Timeout of the heartbeat (empty cmd) prompt
 	
-	def open(self):
+	__discover_boot_spread_ms = 3000	# Slot discovery: once a DUT has booted, wait this long for the other DUTs
+	
+	@classmethod
+	def loadSlotMap(cls, filename = 'slot_map.dat', device_cache = None):
+		'''Load the slots of the jig from filename, instead of the default COM ports.
+		   One slot per line, in the order of the slots: "<slot name> <UART device>", ex:
+		     slot1 /dev/serial/by-id/usb-FTDI_FT4232H_FT1A2B3C-if00-port0
+		     slot2 /dev/ttyUSB1
+		     slot3 sn:FT1A2B3D
+		     slot4 usb:1-1.4:1.0
+		   "sn:" and "usb:" devices are found by USB serial number or USB location (see DeviceCache)
+		   Empty lines and lines starting with '#' are ignored'''
+		line_re = re.compile('^(\\S+)\\s+(\\S+)$')
+		duts = list()
+		names = set()
+		file = open(filename, 'r')
+		lines = file.readlines()
+		file.close()
+		for line in lines:
+			line = line.strip()
+			if len(line) == 0 or line.startswith('#'):
+				continue
+			res = line_re.match(line)
+			if not res:
+				raise ValueError("%s: Invalid file format (line <%s>)" % (filename, line))
+			if res.group(1) in names:
+				raise ValueError("%s: Duplicated slot <%s>" % (filename, res.group(1)))
+			names.add(res.group(1))
+			uart_name = res.group(2)
+			if uart_name.startswith('sn:') or uart_name.startswith('usb:'):
+				if device_cache is None:
+					device_cache = DeviceCache()
+				uart_name = device_cache.findSerialPort(uart_name.split(':', 1)[1])
+			duts.append(Dut(res.group(1), uart_name))
+		if len(duts) == 0:
+			raise ValueError("%s: No slot" % filename)
+		cls.__all_duts = tuple(duts)
+		logger.info("Loaded %d slots from file <%s>" % (len(duts), filename))
+	
+	def __init__(self, nb_slots, rx_mode = 'sequential', tx_echo = False, latency = None, nb_shards = 0, duts = None):
+		'''nb_slots : (int) number of DUTs plugged into the jig, from left to right,
+		              or None for all the slots (then see discover())
+		   rx_mode  : (string) how the DUT replies are collected:
+		              'sequential' : one DUT after another (wait time is the sum of all DUT replies)
+		              'threads'    : all DUTs at the same time (wait time is the slowest DUT reply)
+		              'reactor'    : all DUTs at the same time, from a single select() loop (POSIX only)
+		              'asyncio'    : all DUTs at the same time, with broadcast() run in its own event loop
+		   tx_echo  : (bool) send cmd bytes as soon as they are echoed by the DUTs (see Dut.setTxEcho())
+		   latency  : (DutLatencyTracker) if not None, the DUT response times are recorded into it,
+		              and the cmd timeouts are derived from it
+		   nb_shards : (int) if not 0, the slots are split into nb_shards worker processes (see DutShardPool),
+		              each of them handling the UARTs of its slots with rx_mode
+		   duts     : (tuple of Dut) the DUTs of the set, instead of the slots of the jig'''
+		if rx_mode not in ('sequential', 'threads', 'reactor', 'asyncio'):
+			raise ValueError("Invalid DUT rx mode <%s>" % rx_mode)
+		if duts is None:
+			if (nb_slots is not None) and (nb_slots > len(self.__all_duts)):
+				raise ValueError("Invalid number of DUTs (%d slots in the jig)" % len(self.__all_duts))
+			duts = self.__all_duts[0:nb_slots] if nb_slots is not None else self.__all_duts
+		self.__duts = duts
 		for dut in self.__duts:
-			dut.open()
+			dut.setTxEcho(tx_echo)
+		self.__rx_mode = rx_mode
+		self.__reactor = DutReactor() if (rx_mode == 'reactor') and (nb_shards == 0) else None
+		self.__latency = latency
+		self.__shards = DutShardPool(self.__duts, nb_shards, rx_mode, tx_echo) if nb_shards else None
+	
+	def open(self, boot_timeout_ms = None):
+		'''boot_timeout_ms : if not None, the DUTs have just been powered on:
+		                    open all of them at the same time, and probe each of them as soon as it has booted'''
+		if (boot_timeout_ms is None) and (self.__shards is None):
+			for dut in self.__duts:
+				dut.open()
+			self.__logSlots()
+			return
+		
+		if boot_timeout_ms is not None:
+			logger.info("Wait for DUTs boot (%d ms max)..." % boot_timeout_ms)
+		time_start = time()
+		errors = self.openDuts(self.__duts, boot_timeout_ms)
+		# As with sequential opening, a DUT which fails its 1st probe stops the test
+		for dut, error in zip(self.__duts, errors):
+			if error is not None:
+				raise ValueError("DUT <%s>: %s" % (dut.getName(), error))
+		logger.info("DUTs ready in %d ms" % ((time() - time_start) * 1000))
+		self.__logSlots()
+	
+	def discover(self, boot_timeout_ms):
+		'''Open all the slots of the set at the same time, and keep only the slots with a DUT answering
+		   to the probe cmd. The populated slots don't need to be contiguous.
+		   Empty slots are given up __discover_boot_spread_ms after the 1st DUT has booted'''
+		logger.info("Discover DUTs in slots <%s>..." % "> <".join([dut.getName() for dut in self.__duts]))
+		time_start = time()
+		errors = self.openDuts(self.__duts, boot_timeout_ms, self.__discover_boot_spread_ms)
+		for dut, error in zip(self.__duts, errors):
+			if error is not None:
+				logger.info("No DUT in slot <%s> (%s)" % (dut.getName(), error))
+		self.__duts = tuple([dut for dut, error in zip(self.__duts, errors) if error is None])
+		logger.info("Discovered %d DUTs in %d ms" % (len(self.__duts), (time() - time_start) * 1000))
+		self.__logSlots()
+		if len(self.__duts) == 0:
+			raise ValueError("No DUT found")
+	
+	def openDuts(self, duts, boot_timeout_ms, boot_spread_ms = None):
+		'''Open duts at the same time (see Dut.open()), without stopping at the 1st failure.
+		   boot_spread_ms : if not None, the DUTs not booted boot_spread_ms after the 1st booted DUT
+		                    are given up
+		   Return a list of error reasons (None if the DUT is open), in the same order as duts'''
+		if self.__shards is not None:
+			return self.__shards.openDuts(duts, boot_timeout_ms, boot_spread_ms)
+		if len(duts) == 0:
+			return list()
+		first_boot_times = list()
+		
+		def abort():
+			return bool(first_boot_times) and (time() - first_boot_times[0]) * 1000 > boot_spread_ms
+		
+		def tryOpen(dut):
+			try:
+				dut.open(boot_timeout_ms, abort if boot_spread_ms is not None else None)
+			except (ValueError, serial.SerialException) as e:
+				dut.close()
+				return str(e)
+			first_boot_times.append(time())
+			return None
+		
+		with ThreadPoolExecutor(max_workers = len(duts)) as pool:
+			return list(pool.map(tryOpen, duts))
+	
+	def __logSlots(self):
+		logger.info("Enabled slots: <%s>" % "> <".join([dut.getName() for dut in self.__duts]))
 			
 	def close(self):
+		if self.__shards is not None:
+			self.__shards.close()
 		for dut in self.__duts:
 			dut.close()
 	
@@ -479,25 +1300,204 @@ class DutSet:
 #		return dut
 		
 	def sendCmd(self, cmd, timeout_ms):
+		self.__heartbeat(timeout_ms)
+		
 		logger.info("Send cmd <%s>" % cmd)
 		dut_set_included = list()
+		
+		dut_set_included = [dut for dut in self.__duts if dut not in self.__excluded_duts]
+		
+		timeouts_ms = [self.__timeout(dut, cmd, timeout_ms) for dut in dut_set_included]
+		
+		replies = self.exchange(dut_set_included, cmd, timeouts_ms)
+		
+		return self.__handleReplies(cmd, dut_set_included, replies)
+	
+	async def broadcast(self, cmd, timeout_ms):
+		'''asyncio flavour of sendCmd(): send cmd to all included DUTs and wait for their replies
+		   Return the same list of DutSetResult as sendCmd()'''
+		duts = self.__heartbeatDuts(timeout_ms)
+		if duts:
+			timeouts_ms = [self.__heartbeat_timeout_ms] * len(duts)
+			self.__handleHeartbeat(duts, await self.__exchangeAsync(duts, "", timeouts_ms))
+		
+		logger.info("Send cmd <%s>" % cmd)
+		dut_set_included = [dut for dut in self.__duts if dut not in self.__excluded_duts]
+		timeouts_ms = [self.__timeout(dut, cmd, timeout_ms) for dut in dut_set_included]
+		
+		replies = await self.__exchangeAsync(dut_set_included, cmd, timeouts_ms)
+		
+		return self.__handleReplies(cmd, dut_set_included, replies)
+	
+	def query(self, cmd, timeout_ms):
+		'''Send cmd to all included DUTs, like sendCmd(), but without setting the DUTs which fail it
+		   as failed: for optional cmds, ex: readouts while waiting
+		   Return the list of DutSetResult, cmd_result is None if the DUT failed the cmd'''
+		duts = [dut for dut in self.__duts if dut not in self.__excluded_duts]
+		timeouts_ms = [self.__timeout(dut, cmd, timeout_ms) for dut in duts]
+		replies = self.exchange(duts, cmd, timeouts_ms)
 		dut_set_results = list()
+		for dut, (result, error_reason) in zip(duts, replies):
+			if (result is not None) and (self.__latency is not None):
+				self.__latency.record(dut.getName(), cmd, dut.getRxTime())
+			if (result is not None) and (result.rc != 0):
+				error_reason = "rc=%d" % result.rc
+				result = None
+			if result is None:
+				logger.info("board <%s>: no reply to <%s> (%s)" % (dut.getName(), cmd, error_reason))
+			dut_set_results.append(DutSetResult(dut, result))
+		return dut_set_results
+	
+	def checkAlive(self):
+		'''Send an empty cmd to all included DUTs, at the same time.
+		   The DUTs which don't reply with a prompt within a short timeout are set as failed and excluded'''
+		duts = [dut for dut in self.__duts if dut not in self.__excluded_duts]
+		if duts:
+			timeouts_ms = [self.__heartbeat_timeout_ms] * len(duts)
+			self.__handleHeartbeat(duts, self.exchange(duts, "", timeouts_ms))
+	
+	def __heartbeat(self, timeout_ms):
+		'''Check the DUTs are alive before a cmd with timeout_ms, if needed'''
+		duts = self.__heartbeatDuts(timeout_ms)
+		if duts:
+			timeouts_ms = [self.__heartbeat_timeout_ms] * len(duts)
+			self.__handleHeartbeat(duts, self.exchange(duts, "", timeouts_ms))
+	
+	def __heartbeatDuts(self, timeout_ms):
+		'''Return the included DUTs to check before a cmd with timeout_ms:
+		   all of them before a long cmd, otherwise those which have been silent for too long.
+		   Waiting for a dead DUT then costs the heartbeat timeout instead of the cmd timeout'''
+		duts = [dut for dut in self.__duts if dut not in self.__excluded_duts]
+		if timeout_ms > self.__heartbeat_cmd_timeout_ms:
+			return duts
+		return [dut for dut in duts if dut.getSilenceTime() > self.__heartbeat_silence_ms]
+	
+	def __handleHeartbeat(self, duts, replies):
+		logger.info("Heartbeat <%s>" % "> <".join([dut.getName() for dut in duts]))
+		for dut, (result, error_reason) in zip(duts, replies):
+			# The empty cmd has no rc: the prompt is enough
+			if result is None:
+				logger.info("board <%s>: no heartbeat (%s)" % (dut.getName(), error_reason))
+				dut.setPass(False, "heartbeat: %s" % error_reason)
+				self.excludeDut(dut)
+	
+	def exchange(self, duts, cmd, timeouts_ms):
+		'''Send cmd to duts and wait for their replies. The DUTs status is not updated.
+		   timeouts_ms : list of timeouts (ms), one per dut
+		   Return a list of (CmdResult, error_reason) tuples, in the same order as duts'''
+		if self.__shards is not None:
+			return self.__shards.exchange(duts, cmd, timeouts_ms)
+		if self.__rx_mode == 'asyncio':
+			return asyncio.run(self.__exchangeAsync(duts, cmd, timeouts_ms))
 		
+		self.__transmit(duts, cmd)
+		
+		if self.__rx_mode == 'threads':
+			return self.__collectThreads(duts, timeouts_ms)
+		elif self.__rx_mode == 'reactor':
+			return self.__reactor.collect(duts, timeouts_ms)
+		else:
+			return [self.__collect(dut, t) for dut, t in zip(duts, timeouts_ms)]
+	
+	async def __exchangeAsync(self, duts, cmd, timeouts_ms):
+		'''asyncio flavour of exchange()'''
+		if self.__shards is not None:
+			return await asyncio.get_running_loop().run_in_executor(None, self.exchange, duts, cmd, timeouts_ms)
+		await asyncio.get_running_loop().run_in_executor(None, self.__transmit, duts, cmd)
+		return await asyncio.gather(*[self.__collectAsync(dut, t) for dut, t in zip(duts, timeouts_ms)])
+	
+	def __transmit(self, duts, cmd):
+		'''Send cmd to all duts at the same time:
+		   each byte is written to every DUT, then the byte delay (or echo wait) is applied once,
+		   so the transmit time does not depend on the number of DUTs'''
+		for dut in duts:
+			dut.txBegin(cmd)
+		for byte in cmd + '\r':
+			for dut in duts:
+				dut.txByte(byte)
+			Dut.txWait(duts)
+		for dut in duts:
+			dut.txEnd()
+	
+	def sendCmds(self, cmds, timeout_ms):
+		'''Send a sequence of cmds to all included DUTs.
+		   Each DUT gets its next cmd as soon as it has replied to the previous one,
+		   without waiting for the other DUTs. A DUT stops at its first failed cmd.
+		   timeout_ms : timeout of each cmd (upper bound, see DutLatencyTracker)
+		   Return a list (one item per cmd) of lists of DutSetResult, as returned by sendCmd().
+		   The DUTs which stopped before a cmd are not in the results of this cmd.'''
+		self.__heartbeat(timeout_ms)
+		
+		logger.info("Send cmds <%s>" % "> <".join(cmds))
 		dut_set_included = [dut for dut in self.__duts if dut not in self.__excluded_duts]
 		
-		for dut in dut_set_included:
-			dut.sendCmd(cmd)
+		timeouts_ms = [[self.__timeout(dut, cmd, timeout_ms) for cmd in cmds] for dut in dut_set_included]
+		sequences = self.runSequences(dut_set_included, cmds, timeouts_ms)
 		
-		for dut in dut_set_included:
-			try:
-				result = dut.getResult(timeout_ms)
+		cmds_results = list()
+		for index, cmd in enumerate(cmds):
+			logger.info("Cmd <%s>:" % cmd)
+			duts = [dut for dut, replies in zip(dut_set_included, sequences) if index < len(replies)]
+			replies = [replies[index][:2] for replies in sequences if index < len(replies)]
+			rx_times_ms = [replies[index][2] for replies in sequences if index < len(replies)]
+			cmds_results.append(self.__handleReplies(cmd, duts, replies, True, rx_times_ms))
+		return cmds_results
+	
+	def runSequences(self, duts, cmds, timeouts_ms):
+		'''Send cmds to each of duts (see sendCmds()). The DUTs status is not updated.
+		   timeouts_ms : list (one item per dut) of lists of timeouts (ms), one per cmd
+		   Return a list (one item per dut) of lists of (CmdResult, error_reason, response time in ms) tuples'''
+		if self.__shards is not None:
+			return self.__shards.runSequences(duts, cmds, timeouts_ms)
+		if self.__rx_mode == 'sequential':
+			return [self.__runSequence(dut, cmds, t) for dut, t in zip(duts, timeouts_ms)]
+		if len(duts) == 0:
+			return list()
+		with ThreadPoolExecutor(max_workers = len(duts)) as pool:
+			return list(pool.map(lambda dut, t: self.__runSequence(dut, cmds, t), duts, timeouts_ms))
+	
+	def __runSequence(self, dut, cmds, timeouts_ms):
+		'''Send cmds to dut, one after another, until one of them fails.
+		   Return the list of (CmdResult, error_reason, response time in ms) tuples of the cmds sent:
+		   the response time is kept for each cmd, as dut.getRxTime() only returns the one of the last cmd'''
+		replies = list()
+		for cmd, timeout_ms in zip(cmds, timeouts_ms):
+			dut.sendCmd(cmd)
+			(result, error_reason) = self.__collect(dut, timeout_ms)
+			replies.append((result, error_reason, dut.getRxTime()))
+			if (result is None) or (result.rc != 0):
+				break
+		return replies
+	
+	def __timeout(self, dut, cmd, timeout_ms):
+		'''Return the timeout of cmd for dut: timeout_ms, or less if the DUT response times are tracked'''
+		if self.__latency is None:
+			return timeout_ms
+		return self.__latency.timeout(dut.getName(), cmd, timeout_ms)
+	
+	def __handleReplies(self, cmd, duts, replies, cmd_in_reason = False, rx_times_ms = None):
+		'''cmd     : cmd sent to duts
+		   duts    : list of Dut the cmd was sent to
+		   replies : list of (CmdResult, error_reason) tuples, in the same order as duts
+		   cmd_in_reason : add the cmd to the failure reason of the DUTs
+		   rx_times_ms : list of the response times (ms) of duts to cmd, or None if cmd is the
+		           last cmd sent to duts (see Dut.getRxTime())
+		   Set the DUTs which failed the cmd as failed and exclude them.
+		   Return the list of DutSetResult'''
+		if rx_times_ms is None:
+			rx_times_ms = [dut.getRxTime() for dut in duts]
+		dut_set_results = list()
+		for dut, (result, error_reason), rx_time_ms in zip(duts, replies, rx_times_ms):
+			if (result is not None) and (self.__latency is not None):
+				self.__latency.record(dut.getName(), cmd, rx_time_ms)
+			if result is not None:
 				logger.info("board <%s>: rc=%d" %
 					(dut.getName(), result.rc) )
 				if(result.rc != 0):
-					raise ValueError("board <%s>: rc=%d" %
-					(dut.getName(), result.rc) )
-			except ValueError as e:
-				error_reason = str(e)
+					error_reason = "board <%s>: rc=%d" % (dut.getName(), result.rc)
+			if (error_reason is not None) and cmd_in_reason:
+				error_reason = "%s: %s" % (cmd, error_reason)
+			if error_reason is not None:
 				logger.info("board <%s>: command error (%s)" %
 				(dut.getName(), error_reason))
 				result = None
@@ -510,8 +1510,388 @@ class DutSet:
 			dut_set_results.append(DutSetResult(dut, result))
 		
 		return dut_set_results
+	
+	def __collect(self, dut, timeout_ms):
+		'''Wait for the reply of a single DUT.
+		   Return a (CmdResult, None) tuple, or (None, error_reason) if the DUT failed to reply'''
+		try:
+			return (dut.getResult(timeout_ms), None)
+		except ValueError as e:
+			return (None, str(e))
+	
+	async def __collectAsync(self, dut, timeout_ms):
+		'''asyncio flavour of __collect()'''
+		try:
+			return (await dut.result(timeout_ms), None)
+		except ValueError as e:
+			return (None, str(e))
+	
+	def __collectThreads(self, duts, timeouts_ms):
+		'''Wait for the replies of all DUTs at the same time, one worker per DUT.
+		   The replies are returned in the same order as duts, so that the
+		   caller handles Pass/Fail and exclusion exactly as in sequential mode'''
+		if not duts:
+			return list()
+		with ThreadPoolExecutor(max_workers = len(duts)) as pool:
+			return list(pool.map(self.__collect, duts, timeouts_ms))
 		
-# TODO : this class is not implemented
+class Li840Sample:
+	'''Measure block of the co2 meter (see the output example below).
+	   The fields of the <raw> block are prefixed with "raw_".
+	   All fields are floats, or None if not in the block'''
+	fields = ('celltemp', 'cellpres', 'co2', 'co2abs', 'h2o', 'h2oabs', 'h2odewpoint', 'ivolt',
+		  'raw_co2', 'raw_co2ref', 'raw_h2o', 'raw_h2oref')
+	__slots__ = ('time',) + fields		# time : (time()) reception time of the block
+	
+	def __init__(self):
+		for name in self.__slots__:
+			setattr(self, name, None)
+	
+	def __str__(self):
+		return " ".join(["%s=%s" % (name, getattr(self, name)) for name in self.fields])
+
+class Li840Parser:
+	'''Parse the <li840> measure blocks from the co2 meter UART bytes, incrementally:
+	   each byte is scanned once, and the position in the current block is kept between chunks.
+	   On corrupt input (unexpected tag, invalid value, non-ascii characters) the current block
+	   is dropped, and the parser waits for the next <li840> tag.
+	   The other blocks (replies to the configuration cmds) are kept into replies'''
+	__tag_re = re.compile(b'^/?[a-zA-Z0-9_]+$')
+	__max_len = 64		# Longer tags or values are garbage
+	
+	def __init__(self):
+		self.__buffer = bytearray()	# bytes not parsed yet: incomplete tag or value
+		self.__path = list()		# names of the open tags, empty outside of a block
+		self.__sample = None		# sample of the current block
+		self.__values = dict()		# values (string) of the current block outside of <data>, by path
+		self.nb_errors = 0		# number of corrupt blocks dropped
+		self.replies = deque(maxlen = 8)	# values of the last blocks without measure, ex: {'ack': 'true'}
+	
+	def feed(self, chunk):
+		'''chunk : (bytes-like) bytes received from the co2 meter
+		   Return the list of Li840Sample of the blocks completed by chunk'''
+		samples = list()
+		buffer = self.__buffer
+		buffer += chunk
+		pos = 0
+		while True:
+			tag_start = buffer.find(b'<', pos)
+			tag_end = buffer.find(b'>', tag_start) if tag_start >= 0 else -1
+			if tag_end < 0:
+				# Incomplete value or tag: keep it for the next chunk (the value is needed by its closing tag)
+				if not self.__path:
+					pos = tag_start if tag_start >= 0 else len(buffer)
+				if len(buffer) - pos > self.__max_len:
+					if self.__path:
+						self.__resync()
+					pos = len(buffer)
+				break
+			# A '<' in a tag is garbage before the actual tag
+			tag_start = buffer.rfind(b'<', tag_start, tag_end)
+			sample = self.__tag(bytes(buffer[tag_start + 1:tag_end]), buffer[pos:tag_start])
+			if sample is not None:
+				samples.append(sample)
+			pos = tag_end + 1
+		del buffer[:pos]
+		return samples
+	
+	def __tag(self, tag, text):
+		'''Handle tag (without '<' and '>'), text is the bytes received before it
+		   Return the Li840Sample completed by tag, or None'''
+		if tag == b'li840':
+			if self.__path:
+				self.__resync()
+			self.__path = ['li840']
+			self.__sample = Li840Sample()
+			self.__values = dict()
+			return None
+		if not self.__path:
+			# Outside of a block
+			return None
+		if not self.__tag_re.match(tag):
+			self.__resync()
+			return None
+		if not tag.startswith(b'/'):
+			self.__path.append(tag.decode())
+			return None
+		
+		name = tag[1:].decode()
+		if name != self.__path[-1]:
+			self.__resync()
+			return None
+		field = "_".join(self.__path[2:])
+		if (len(self.__path) > 2) and (self.__path[1] == 'data') and (field in Li840Sample.fields):
+			try:
+				setattr(self.__sample, field, float(text))
+			except ValueError:
+				self.__resync()
+				return None
+		elif (len(self.__path) > 1) and (self.__path[1] != 'data'):
+			try:
+				self.__values["_".join(self.__path[1:])] = bytes(text).decode('ascii').strip()
+			except UnicodeDecodeError:
+				self.__resync()
+				return None
+		self.__path.pop()
+		if self.__path:
+			return None
+		sample = self.__sample
+		self.__sample = None
+		if sample.co2 is None:
+			# Not a measure block
+			if self.__values:
+				self.replies.append(self.__values)
+			return None
+		return sample
+	
+	def __resync(self):
+		self.nb_errors += 1
+		self.__path = list()
+		self.__sample = None
+
+class StabWindow:
+	'''Rolling window of the last nb_sample co2 ppm samples, for the stabilization criteria.
+	   Each new sample costs O(1): the sum is updated on the fly, and the min / max are
+	   the heads of monotonic deques (indexes of the samples which may still become the min / max)'''
+	
+	def __init__(self, nb_sample, tol_ppm, tol_ratio):
+		'''nb_sample : (int) number of samples of the window
+		   tol_ppm   : the window is stable if max - min < tol_ppm...
+		   tol_ratio : ... or if (max - min) / mean < tol_ratio'''
+		self.nb_sample = nb_sample
+		self.tol_ppm = tol_ppm
+		self.tol_ratio = tol_ratio
+		self.__ppms = deque()
+		self.__sum = 0.0
+		self.__mins = deque()	# (index, ppm), ppm increasing
+		self.__maxs = deque()	# (index, ppm), ppm decreasing
+		self.__index = 0	# index of the next sample
+	
+	def add(self, ppm):
+		self.__ppms.append(ppm)
+		self.__sum += ppm
+		if len(self.__ppms) > self.nb_sample:
+			self.__sum -= self.__ppms.popleft()
+		while self.__mins and self.__mins[-1][1] >= ppm:
+			self.__mins.pop()
+		self.__mins.append((self.__index, ppm))
+		while self.__maxs and self.__maxs[-1][1] <= ppm:
+			self.__maxs.pop()
+		self.__maxs.append((self.__index, ppm))
+		self.__index += 1
+		oldest = self.__index - self.nb_sample
+		if self.__mins[0][0] < oldest:
+			self.__mins.popleft()
+		if self.__maxs[0][0] < oldest:
+			self.__maxs.popleft()
+	
+	def isFull(self):
+		return len(self.__ppms) >= self.nb_sample
+	
+	def last(self):
+		return self.__ppms[-1]
+	
+	def mean(self):
+		return self.__sum / len(self.__ppms)
+	
+	def errorAbs(self):
+		return self.__maxs[0][1] - self.__mins[0][1]
+	
+	def errorRatio(self):
+		return self.errorAbs() / self.mean()
+	
+	def stableCriterion(self):
+		'''Return the name of the stabilization criterion matched ('err_abs' or 'err_ratio'),
+		   or None if the window is not full or not stable'''
+		if not self.isFull():
+			return None
+		if self.errorAbs() < self.tol_ppm:
+			return 'err_abs'
+		if self.errorRatio() < self.tol_ratio:
+			return 'err_ratio'
+		return None
+
+class StabPredictor:
+	'''Forecast the settled co2 ppm after a gas injection, before the samples are flat.
+	   The samples are fitted to a first-order decay y[n+1] = a * y[n] + b (least squares,
+	   updated in O(1) per sample): the settled ppm is the asymptote b / (1 - a), and its
+	   standard deviation is estimated from the fit residuals (delta method).
+	   The model has no dead time: the samples stay flat until the gas reaches the meter, and a fit
+	   of these samples forecasts the old level. So the fit only starts once the samples move away
+	   from the first one (or when start() is called)'''
+	__confidence_k = 2.0	# The confidence bound is 2 standard deviations (~95%)
+	
+	def __init__(self, min_samples = 6, min_move_ppm = None):
+		'''min_samples  : (int) no forecast with fewer samples
+		   min_move_ppm : the fit starts at the first sample which is min_move_ppm away from
+		                  the first one, or None to fit all the samples'''
+		self.min_samples = min_samples
+		self.min_move_ppm = min_move_ppm
+		self.__first = None	# 1st sample
+		self.__started = False
+		self.__offset = None	# 1st sample fitted: the fit is done on the samples minus __offset, for precision
+		self.__prev = None
+		self.__n = 0		# Sums over the (y[n], y[n+1]) pairs
+		self.__sx = 0.0
+		self.__sz = 0.0
+		self.__sxx = 0.0
+		self.__sxz = 0.0
+		self.__szz = 0.0
+	
+	def start(self):
+		'''Start the fit with the next sample, even if the samples have not moved'''
+		self.__started = True
+	
+	def add(self, ppm):
+		if self.__first is None:
+			self.__first = ppm
+		if not self.__started:
+			if (self.min_move_ppm is not None) and (abs(ppm - self.__first) < self.min_move_ppm):
+				return
+			self.__started = True
+		self.__fit(ppm)
+	
+	def __fit(self, ppm):
+		if self.__offset is None:
+			self.__offset = ppm
+		z = ppm - self.__offset
+		if self.__prev is not None:
+			x = self.__prev
+			self.__n += 1
+			self.__sx += x
+			self.__sz += z
+			self.__sxx += x * x
+			self.__sxz += x * z
+			self.__szz += z * z
+		self.__prev = z
+	
+	def predict(self):
+		'''Return (settled ppm, confidence bound in ppm), or None if there is no forecast yet'''
+		n = self.__n
+		if (n + 1 < self.min_samples) or (n < 3):
+			return None
+		det = n * self.__sxx - self.__sx ** 2
+		if det <= 0:
+			return None
+		a = (n * self.__sxz - self.__sx * self.__sz) / det
+		if not (-1 < a < 1):
+			# Not a converging decay
+			return None
+		b = (self.__sz - a * self.__sx) / n
+		rss = max(0.0, self.__szz - a * self.__sxz - b * self.__sz)
+		var_res = rss / (n - 2)
+		# Gradient of b / (1 - a), and covariance of (a, b) = var_res * inverse([[sxx, sx], [sx, n]])
+		grad_a = b / (1 - a) ** 2
+		grad_b = 1 / (1 - a)
+		var = var_res / det * (grad_a ** 2 * n - 2 * grad_a * grad_b * self.__sx + grad_b ** 2 * self.__sxx)
+		return (self.__offset + b / (1 - a), self.__confidence_k * max(0.0, var) ** 0.5)
+
+class StabTuner:
+	'''Tune the co2 meter stabilization criteria from recorded readings (see Co2Meter.setRecordFile()).
+	   The samples recorded after each gas injection are replayed with each candidate criteria:
+	   the reading must be within accuracy_ppm of the level the chamber eventually settled at (mean
+	   of the last samples of the longest recording after the injection). The criteria which reads
+	   all the injections accurately in the shortest mean time are saved into the co2meter profile'''
+	__nb_samples = range(2, 15)				# Candidate window sizes, 2 Hz samples
+	__tols_ppm = (2, 4, 6, 8, 10, 15, 20)
+	__tols_ratio = (0.001, 0.002, 0.003, 0.005, 0.0075, 0.01)
+	__ref_duration_ms = 7000	# The settled level is the mean of the last 7 seconds of samples...
+	__min_duration_ms = 30000	# ... of the injections recorded for at least 30 seconds
+	
+	def __init__(self):
+		self.__segments = list()	# list of [(time_ms, ppm)] samples after an injection
+	
+	def loadRecords(self, filename = 'co2meter_record.dat'):
+		'''Keep the longest recording after each injection (the other ones are its beginning)'''
+		segment_re = re.compile('^segment ([0-9.]+) ?(.*)$')
+		sample_re = re.compile('^([0-9]+):([0-9.]+)$')
+		segments = dict()	# samples, by injection time
+		file = open(filename, 'r')
+		lines = file.read().splitlines()
+		file.close()
+		for line in lines:
+			res = segment_re.match(line)
+			if not res:
+				raise ValueError('%s: Invalid file format' % filename)
+			samples = list()
+			for item in res.group(2).split():
+				sample = sample_re.match(item)
+				if not sample:
+					raise ValueError('%s: Invalid file format' % filename)
+				samples.append((int(sample.group(1)), float(sample.group(2))))
+			if len(samples) > len(segments.get(res.group(1), ())):
+				segments[res.group(1)] = samples
+		self.__segments = [samples for samples in segments.values()
+				if samples and samples[-1][0] >= self.__min_duration_ms]
+		logger.info("Loaded %d injection recordings from file <%s> (%d too short)" % (
+				len(self.__segments), filename, len(segments) - len(self.__segments)))
+	
+	def tune(self, accuracy_ppm):
+		'''Return the fastest (nb_sample, tol_ppm, tol_ratio) reading all the recorded injections
+		   within accuracy_ppm, or None if no candidate does'''
+		if not self.__segments:
+			raise ValueError('No injection recording')
+		refs = [self.__reference(samples) for samples in self.__segments]
+		best = None
+		for nb_sample in self.__nb_samples:
+			for tol_ppm in self.__tols_ppm:
+				for tol_ratio in self.__tols_ratio:
+					mean_time_ms = self.__replay(nb_sample, tol_ppm, tol_ratio, refs, accuracy_ppm)
+					if (mean_time_ms is not None) and ((best is None) or (mean_time_ms < best[0])):
+						best = (mean_time_ms, (nb_sample, tol_ppm, tol_ratio))
+		if best is None:
+			return None
+		logger.info("Tuned co2meter profile: nb_sample=%d, tol_ppm=%0.1f, tol_ratio=%0.4f (mean reading time %d ms)" % (
+				best[1] + (best[0],)))
+		return best[1]
+	
+	def __reference(self, samples):
+		end_ms = samples[-1][0]
+		last_ppms = [ppm for time_ms, ppm in samples if time_ms >= end_ms - self.__ref_duration_ms]
+		return sum(last_ppms) / len(last_ppms)
+	
+	def __replay(self, nb_sample, tol_ppm, tol_ratio, refs, accuracy_ppm):
+		'''Return the mean reading time (ms) of the recorded injections with the criteria,
+		   or None if one of them is not read within accuracy_ppm'''
+		total_ms = 0
+		for samples, ref_ppm in zip(self.__segments, refs):
+			window = StabWindow(nb_sample, tol_ppm, tol_ratio)
+			for time_ms, ppm in samples:
+				window.add(ppm)
+				if window.stableCriterion() is not None:
+					break
+			else:
+				return None
+			if abs(ppm - ref_ppm) > accuracy_ppm:
+				return None
+			total_ms += time_ms
+		return total_ms / len(self.__segments)
+	
+	@staticmethod
+	def saveProfile(profile, filename = 'co2meter_profile.dat'):
+		'''profile : (nb_sample, tol_ppm, tol_ratio)'''
+		file = open(filename, 'w')
+		file.write("nb_sample %d\ntol_ppm %s\ntol_ratio %s\n" % profile)
+		file.close()
+		logger.info("Saved co2meter profile into file <%s>" % filename)
+	
+	@staticmethod
+	def loadProfile(filename = 'co2meter_profile.dat'):
+		'''Return (nb_sample, tol_ppm, tol_ratio)'''
+		line_re = re.compile('^(nb_sample|tol_ppm|tol_ratio) ([0-9.]+)$')
+		values = dict()
+		file = open(filename, 'r')
+		lines = file.read().splitlines()
+		file.close()
+		for line in lines:
+			res = line_re.match(line)
+			if not res:
+				raise ValueError('%s: Invalid file format' % filename)
+			values[res.group(1)] = res.group(2)
+		if len(values) != 3:
+			raise ValueError('%s: Invalid file format' % filename)
+		return (int(values['nb_sample']), float(values['tol_ppm']), float(values['tol_ratio']))
+
 # Output example (CR added for convenience) :
 # <li840>
 # 	<data>
@@ -535,30 +1915,38 @@ class Co2Meter:
 	#__uart
 	__measblock_timeout_ms = 2000			# Timeout to get a measure block
 	__stab_timeout_ms = 40000			# Timeout for co2 ppm stabilization
-	__sample_rate_hz = 2				# co2meter sends 2 samples per second
+	__outrate_s = 0.5				# Output period set at open(): 0.5 s is the fastest the LI-840 supports...
+	__sample_rate_hz = 2				# ... so the co2meter sends 2 samples per second
 	__stab_nb_sample = (__sample_rate_hz * 7)	# Last 7 seconds of samples must match the stabilization criteria
 	__stab_nb_sample_fast = (__sample_rate_hz * 1)	# Last 1 seconds of samples must match the stabilization criteria in fast mode
 	__stab_tol_ratio = (5.0/1000.0)			# last samples must be within +-0.5% of the mean
 	__stab_tol_ppm = 10				# last samples must be within +-10 ppm
+	__nb_sample_max = (__sample_rate_hz * 120)	# The last 2 minutes of samples are kept by the background reader
+	__profile_filename = 'co2meter_profile.dat'	# Stabilization criteria tuned for the jig (see StabTuner), if any
+	__output_fields = ('co2',)			# Fields of the measure blocks set at open(), the other ones are disabled
+	__config_timeout_ms = 3000			# Timeout of the replies to the configuration cmds
+	__predict_min_move_ppm = 20			# No forecast until the samples move 20 ppm from the 1st one after the injection...
+	__predict_min_delay_ms = 15000			# ... or until 15 seconds after the injection (dead time of the gas to the meter)
 	def __init__(self, uart_name = 'COM100'):
 		self.__uart = serial.Serial()
 		self.__uart.setPort(uart_name)
 		self.__uart.setBaudrate(9600)
 		self.__uart.setTimeout(0.1)
 		self.__logfile = None
-		# TODO: in some cases, the co2meter seems to send an incomplete block
-		# Why ? are we misreading the uart ?
-		# In the mean time, just don't try to find blocks with this simple regexp,
-		# but use the complex "__meas_re" directly
-		#self.__measblock_re = re.compile('<li840>.*?</li840>')	# '.*?' is the non-greedy version of '.*'
-		self.__meas_re = re.compile('''<li840>.*?
-						<data>
-						.*?
-						<co2>([0-9]+\.[0-9]+)(e([0-9]+))?</co2>
-						.*?
-						</data>
-						.*?
-					</li840>''', re.VERBOSE)
+		# In some cases, the co2meter seems to send an incomplete block, or non-ascii characters:
+		# the parser drops the corrupt blocks
+		self.__parser = Li840Parser()
+		self.__rx_buffer = bytearray(512)	# UART bytes are read into this buffer
+		self.__rx_view = memoryview(self.__rx_buffer)
+		self.__samples = deque(maxlen = self.__nb_sample_max)	# Li840Sample of the last samples received
+		self.__samples_cond = threading.Condition()	# protects __samples, notified at each new sample
+		self.__nb_samples = 0			# Number of samples received since open()
+		self.__last_sample_time = None		# Time of the last sample received
+		self.__reader = None			# Background reader thread
+		self.__reader_stop = False
+		self.__reader_error = None		# Error which stopped the background reader
+		self.__record_filename = None		# Samples of the stable readings are recorded into this file (see StabTuner)
+		self.__record_segment = None		# (since, [(time, ppm)]) of the last stable reading, not recorded yet
 
 	def __log_open(self):
 		# Create log file
@@ -567,84 +1955,266 @@ class Co2Meter:
 
 	def log(self, uart_bytes):
 		# Strip "\n" to avoid "doubled" carriage returns
-		stripped_uart_bytes = uart_bytes.replace('\n', '')
-		self.__logfile.write(stripped_uart_bytes.encode())
+		write_without_lf(self.__logfile.write, uart_bytes)
 					
 	def open(self):
+		if os.path.isfile(self.__profile_filename):
+			self.loadProfile(self.__profile_filename)
 		self.__log_open()
 		self.__uart.open()
-		# TODO: initialize co2 meter settings
-		# We use default settings for now...
+		self.__configure()
+		self.__uart.flushInput()
+		self.__parser = Li840Parser()
+		self.__samples.clear()
+		self.__nb_samples = 0
+		self.__last_sample_time = time()
+		self.__reader_stop = False
+		self.__reader_error = None
+		self.__reader = threading.Thread(target = self.__readerLoop, name = "co2meter_reader")
+		self.__reader.daemon = True
+		self.__reader.start()
 		
 	def close(self):
+		if self.__reader is not None:
+			self.__reader_stop = True
+			self.__reader.join()
+			self.__reader = None
+		self.__recordFlush()
 		if self.__uart.isOpen():
 			self.__uart.close()
+	
+	def __configure(self):
+		'''Set the output rate and the fields of the measure blocks, then check they are applied.
+		   The co2 meter keeps working with its previous settings if they are not: just warn'''
+		rs232 = "".join(["<%s>%s</%s>" % (field, str(field in self.__output_fields).lower(), field)
+				for field in self.__rs232Fields()])
+		self.__uart.flushInput()
+		self.__uart.write(("<li840><cfg><outrate>%s</outrate></cfg><rs232>%s</rs232></li840>\n" % (
+				self.__outrate_s, rs232)).encode('ascii'))
+		reply = self.__waitReply('ack')
+		if (reply is None) or (reply['ack'] != 'true'):
+			logger.warn("Co2Meter configuration not acknowledged (%s)" % reply)
+		
+		# Read the settings back
+		self.__uart.write(b"<li840>?</li840>\n")
+		reply = self.__waitReply('cfg_outrate')
+		if reply is None:
+			logger.warn("Co2Meter configuration not applied: no reply to the settings query")
+			return
+		errors = list()
+		try:
+			if float(reply['cfg_outrate']) != self.__outrate_s:
+				errors.append("outrate=%s" % reply['cfg_outrate'])
+		except ValueError:
+			errors.append("outrate=%s" % reply['cfg_outrate'])
+		for field in self.__rs232Fields():
+			enabled = str(field in self.__output_fields).lower()
+			if reply.get('rs232_' + field, enabled) != enabled:
+				errors.append("%s=%s" % (field, reply['rs232_' + field]))
+		if errors:
+			logger.warn("Co2Meter configuration not applied: %s" % ", ".join(errors))
+		else:
+			logger.info("Co2Meter configured: outrate=%s s, fields <%s>" % (self.__outrate_s, "> <".join(self.__output_fields)))
+	
+	def __rs232Fields(self):
+		'''Return the names of the fields of the measure blocks, for the configuration cmds'''
+		return [field for field in Li840Sample.fields if not field.startswith('raw_')] + ['raw']
+	
+	def __waitReply(self, key, timeout_ms = None):
+		'''Return the values of the 1st reply block with key, or None on timeout'''
+		if timeout_ms is None:
+			timeout_ms = self.__config_timeout_ms
+		parser = Li840Parser()
+		time_end = time() + timeout_ms / 1000.0
+		while time() < time_end:
+			chunk = self.__rx_view[:self.__uart.readinto(self.__rx_buffer)]
+			self.log(chunk)
+			parser.feed(chunk)
+			while parser.replies:
+				reply = parser.replies.popleft()
+				if key in reply:
+					return reply
+		return None
+	
+	def loadProfile(self, filename):
+		'''Load the stabilization criteria from filename, instead of the default ones (see StabTuner)'''
+		(self.__stab_nb_sample, self.__stab_tol_ppm, self.__stab_tol_ratio) = StabTuner.loadProfile(filename)
+		logger.info("Loaded co2meter profile from file <%s>: nb_sample=%d, tol_ppm=%0.1f, tol_ratio=%0.4f" % (
+				filename, self.__stab_nb_sample, self.__stab_tol_ppm, self.__stab_tol_ratio))
+	
+	def setRecordFile(self, filename):
+		'''Record the samples of each stable reading with a since time into filename (see StabTuner),
+		   or None to stop recording'''
+		self.__recordFlush()
+		self.__record_filename = filename
+	
+	def __readerLoop(self):
+		'''Background reader: parse the measure blocks sent by the co2 meter into __samples'''
+		try:
+			while not self.__reader_stop:
+				# The measure blocks are parsed from the raw bytes: the non-ascii characters we sometimes
+				# receive - for a yet unknown reason - from the CO2 meter are dropped with their block
+				chunk = self.__rx_view[:self.__uart.readinto(self.__rx_buffer)]
+				if len(chunk) == 0:
+					continue
+				self.log(chunk)
+				samples = self.__parser.feed(chunk)
+				if samples:
+					with self.__samples_cond:
+						self.__last_sample_time = time()
+						for sample in samples:
+							sample.time = self.__last_sample_time
+							self.__samples.append(sample)
+						self.__nb_samples += len(samples)
+						self.__samples_cond.notify_all()
+		except (serial.SerialException, OSError, ValueError) as e:
+			logger.error("Co2Meter reader stopped: %s" % e)
+			with self.__samples_cond:
+				self.__reader_error = e
+				self.__samples_cond.notify_all()
 
 	def parse_ppm(self, measblock):
-		meas = self.__meas_re.search(measblock)
-		co2_ppm  =  1  * float(meas.group(1))
-		if meas.group(3):
-			co2_ppm *= 10 ** int(meas.group(3))
-		return co2_ppm
+		'''measblock : (bytes-like) <li840> measure block'''
+		samples = Li840Parser().feed(measblock)
+		if not samples:
+			raise ValueError('Invalid Co2Meter measure block')
+		return samples[0].co2
 	
-	def read_ppm(self, fast_stab = False):
-		text = ""
-		measblock_time_start = time()
-		stab_time_start = measblock_time_start
-		co2_ppms = list()
-		stab_nb_sample = self.__stab_nb_sample if not fast_stab else self.__stab_nb_sample_fast
+	def read_ppm(self, fast_stab = False, since = None, nb_sample = None, tol_ppm = None, tol_ratio = None,
+			predict_tol_ppm = None):
+		'''Return the co2 ppm once stabilized, from the samples collected by the background reader.
+		   since : (time()) only the samples received after since are used (ex: end of the last gas
+		           injection), or None to use all the samples kept.
+		   nb_sample, tol_ppm, tol_ratio : stabilization criteria (see StabWindow), instead of the
+		           default ones (fast_stab selects the default number of samples)
+		   predict_tol_ppm : if not None, return the forecast of the settled co2 ppm (see StabPredictor)
+		           as soon as its confidence bound is below predict_tol_ppm, if the samples are
+		           not stable before. The samples used start at since, and the forecast waits for
+		           the samples to move (or for a delay after since), as the gas takes time to reach the meter.
+		   If the co2 ppm has been stable long enough, return without waiting for new samples'''
+		if nb_sample is None:
+			nb_sample = self.__stab_nb_sample if not fast_stab else self.__stab_nb_sample_fast
+		window = StabWindow(nb_sample,
+				tol_ppm if tol_ppm is not None else self.__stab_tol_ppm,
+				tol_ratio if tol_ratio is not None else self.__stab_tol_ratio)
+		predictor = StabPredictor(min_move_ppm = self.__predict_min_move_ppm) if predict_tol_ppm is not None else None
 		
-		self.__uart.flushInput()
-		logger.debug("Co2Meter RX :")
-		logger.debug("-----------------------------")
-		while True:
-			chunk = self.__uart.read(512)
-			# Do we need to decode/encode !?
-			# Replace non-ascii characters because we sometimes receive - for a yet unknown reason -
-			# non-ascii characters from the CO2 meter
-			text += chunk.decode('ascii', 'replace')
-			
-			#measblock = self.__measblock_re.search(text)
-			# Hack: see comment above "self.__measblock_re" declaration
-			measblock = self.__meas_re.search(text)
-			if measblock:
-				measblock_time_start = time()
-				self.log(measblock.group(0))
-				co2_ppm = self.parse_ppm(measblock.group(0))
-				#logger.debug("co2meter raw ppm = %.02f" % co2_ppm)
-				co2_ppms.append(co2_ppm)
-				text = text[measblock.end(0):]
+		(co2_ppm, segment) = self.__waitStab(since, window, predictor, predict_tol_ppm)
+		# The record file is written out of the samples lock, not to hold the background reader
+		if segment is not None:
+			self.__record(since, segment)
+		return co2_ppm
+	
+	def __waitStab(self, since, window, predictor, predict_tol_ppm):
+		'''See read_ppm(). Return (co2 ppm, samples to record or None)'''
+		stab_time_start = time()
+		with self.__samples_cond:
+			nb_samples_checked = self.__nb_samples - len(self.__samples)
+			# The samples kept before the call are only checked once, on the newest window:
+			# an older stable window may be stale (ex: the co2 ppm before the gas reaches the meter)
+			index_checked = len(self.__samples) - 1
+			while True:
+				if self.__reader_error is not None:
+					raise ValueError('Co2Meter read error: %s' % self.__reader_error)
+				# Only the samples received since the last check are added to the window
+				nb_new = min(self.__nb_samples - nb_samples_checked, len(self.__samples))
+				nb_samples_checked = self.__nb_samples
+				for index in range(len(self.__samples) - nb_new, len(self.__samples)):
+					sample = self.__samples[index]
+					if (since is None) or (sample.time >= since):
+						window.add(sample.co2)
+						if predictor is not None:
+							if (since is not None) and ((sample.time - since) * 1000 >= self.__predict_min_delay_ms):
+								predictor.start()
+							predictor.add(sample.co2)
+						if index < index_checked:
+							continue
+						co2_ppm = self.__checkStab(window)
+						if co2_ppm is not None:
+							segment = None
+							if (self.__record_filename is not None) and (since is not None):
+								segment = [(sample.time, sample.co2) for sample in self.__samples if sample.time >= since]
+							return (co2_ppm, segment)
+						if predictor is not None:
+							prediction = predictor.predict()
+							if (prediction is not None) and (prediction[1] < predict_tol_ppm):
+								logger.info("co2meter predicted ppm = %.02f +-%.02f" % prediction)
+								return (prediction[0], None)
+				index_checked = 0
 				
-				if len(co2_ppms) >= stab_nb_sample:
-					last_ppms = co2_ppms[-self.__stab_nb_sample:]
-					#print last_ppms
-					mean_ppm = sum(last_ppms) / float(len(last_ppms))
-					min_ppm = min(last_ppms)
-					max_ppm = max(last_ppms)
-					error_abs = max_ppm - min_ppm
-					error_ratio = (max_ppm - min_ppm) / mean_ppm
-					logger.debug("co2meter raw ppm = %.02f, err_abs=%0.1f, err_ratio=%0.6f" % (co2_ppm, error_abs, error_ratio))
-					if error_abs < self.__stab_tol_ppm:
-						co2_ppm = last_ppms[-1]
-						logger.info("co2meter stabilized ppm = %.02f (err_abs OK)" % co2_ppm)
-						return co2_ppm
-					if(error_ratio < self.__stab_tol_ratio):
-						co2_ppm = last_ppms[-1]
-						logger.info("co2meter stabilized ppm = %.02f (err_ratio OK)" % co2_ppm)
-						return co2_ppm
-				else:
-					logger.debug("co2meter raw ppm = %.02f" % co2_ppm)
-
-			now_time = time()
-			measblock_elapsed_time = (now_time - measblock_time_start) * 1000
-			#logger.debug("read measure block elapsed time = %d" % measblock_elapsed_time)
-			if measblock_elapsed_time > self.__measblock_timeout_ms:
+				self.__samples_cond.wait(self.__measblock_timeout_ms / 1000.0)
+				
+				now_time = time()
+				measblock_elapsed_time = (now_time - self.__last_sample_time) * 1000
+				if measblock_elapsed_time > self.__measblock_timeout_ms:
+					raise ValueError('Co2Meter read measure block timeout')
+				
+				stab_elapsed_time = (now_time - stab_time_start) * 1000
+				if stab_elapsed_time > self.__stab_timeout_ms:
+					raise ValueError('Co2Meter stabilization timeout')
+	
+	def waitMean(self, nb_sample, timeout_ms, since = None):
+		'''Wait for a new sample (up to timeout_ms), then return the mean ppm of the last nb_sample
+		   samples received after since, or None if there are fewer'''
+		with self.__samples_cond:
+			nb_samples = self.__nb_samples
+			self.__samples_cond.wait_for(lambda: (self.__nb_samples != nb_samples) or (self.__reader_error is not None),
+					timeout_ms / 1000.0)
+			if self.__reader_error is not None:
+				raise ValueError('Co2Meter read error: %s' % self.__reader_error)
+			if (time() - self.__last_sample_time) * 1000 > self.__measblock_timeout_ms:
 				raise ValueError('Co2Meter read measure block timeout')
-			
-			stab_elapsed_time = (now_time - stab_time_start) * 1000
-			#logger.debug("stabilization elapsed time = %d" % stab_elapsed_time)
-			if stab_elapsed_time > self.__stab_timeout_ms:
-				raise ValueError('Co2Meter stabilization timeout')
+			last_samples = [self.__samples[index] for index in range(max(0, len(self.__samples) - nb_sample), len(self.__samples))]
+		co2_ppms = [sample.co2 for sample in last_samples if (since is None) or (sample.time >= since)]
+		if len(co2_ppms) < nb_sample:
+			return None
+		return sum(co2_ppms) / len(co2_ppms)
+	
+	def getWindowStats(self, time_start, time_end):
+		'''Return (mean ppm, spread ppm, nb samples) of the samples received between time_start and time_end,
+		   or None if there is none'''
+		with self.__samples_cond:
+			co2_ppms = [sample.co2 for sample in self.__samples if time_start <= sample.time <= time_end]
+		if not co2_ppms:
+			return None
+		return (sum(co2_ppms) / len(co2_ppms), max(co2_ppms) - min(co2_ppms), len(co2_ppms))
+	
+	def __record(self, since, samples):
+		'''Record the samples (list of (time, ppm)) of a stable reading after the injection at since.
+		   Each injection is written once to the record file, with the longest of its readings:
+		   when a reading follows another injection (or at close())'''
+		if (self.__record_segment is not None) and (self.__record_segment[0] != since):
+			self.__recordFlush()
+		if (self.__record_segment is None) or (len(samples) >= len(self.__record_segment[1])):
+			self.__record_segment = (since, samples)
+	
+	def __recordFlush(self):
+		'''Append the segment of the last stable reading not recorded yet to the record file'''
+		if self.__record_segment is None:
+			return
+		(since, samples) = self.__record_segment
+		self.__record_segment = None
+		if self.__record_filename is None:
+			return
+		file = open(self.__record_filename, 'a')
+		file.write("segment %.3f %s\n" % (since, " ".join(["%d:%.2f" % ((sample_time - since) * 1000, co2_ppm)
+				for sample_time, co2_ppm in samples])))
+		file.close()
+	
+	def __checkStab(self, window):
+		'''window : (StabWindow) the last sample added is the latest received
+		   Return the stabilized co2 ppm, or None if the window doesn't match the stabilization criteria'''
+		co2_ppm = window.last()
+		if not window.isFull():
+			logger.debug("co2meter raw ppm = %.02f" % co2_ppm)
+			return None
+		logger.debug("co2meter raw ppm = %.02f, err_abs=%0.1f, err_ratio=%0.6f" % (
+				co2_ppm, window.errorAbs(), window.errorRatio()))
+		criterion = window.stableCriterion()
+		if criterion is not None:
+			logger.info("co2meter stabilized ppm = %.02f (%s OK)" % (co2_ppm, criterion))
+			return co2_ppm
+		return None
 				
 class ITTDot:
 	def __init__(self, time_ms, ppm):
@@ -879,18 +2449,105 @@ class JigITT:
 		
 	
 				
+class DwellTable:
+	'''DUT ppm stabilization wait times, per dot transition (from the previous dot target ppm, or 0
+	   for the 1st dot, to the dot target ppm).
+	   The table is tuned from the history of the waits and of the DUT verification errors which
+	   followed them (see Co2Jig.recordDwell()): the wait of a transition is the shortest one after
+	   which the errors stayed well within the verification tolerance'''
+	__bucket_ms = 5000		# Waits are grouped by 5 s
+	__nb_result_min = 5		# A wait needs this many DUT results to be recommended
+	
+	def __init__(self):
+		self.__dwells = dict()	# (from ppm, to ppm) -> wait time (ms)
+	
+	def getDwellMs(self, from_ppm, to_ppm, default_ms):
+		return self.__dwells.get((from_ppm, to_ppm), default_ms)
+	
+	def tuneFromHistory(self, filename = 'dwell_history.csv', error_margin = 0.5):
+		'''error_margin : the verification errors after the wait must be lower than
+		                  error_margin * the verification tolerance of the dot'''
+		results = dict()	# (from ppm, to ppm) -> {wait bucket (ms) -> list of (wait ms, error / tolerance)}
+		file = open(filename, 'r', newline='')
+		for row in csv.reader(file, delimiter='\t'):
+			if len(row) != 7:
+				raise ValueError('%s: Invalid file format' % filename)
+			(date, from_ppm, to_ppm, dwell_ms, dut, error, tol_coef) = row
+			bucket_ms = (int(dwell_ms) // self.__bucket_ms) * self.__bucket_ms
+			buckets = results.setdefault((int(from_ppm), int(to_ppm)), dict())
+			buckets.setdefault(bucket_ms, list()).append((int(dwell_ms), float(error) / float(tol_coef)))
+		file.close()
+		
+		dwells = dict()
+		for transition, buckets in sorted(results.items()):
+			# Shortest wait after which all the longer waits are accurate too
+			dwell_ms = None
+			for bucket_ms in sorted(buckets.keys(), reverse = True):
+				if max([error for wait_ms, error in buckets[bucket_ms]]) > error_margin:
+					break
+				if len(buckets[bucket_ms]) >= self.__nb_result_min:
+					# Shortest wait actually used in the bucket
+					dwell_ms = min([wait_ms for wait_ms, error in buckets[bucket_ms]])
+			if dwell_ms is not None:
+				dwells[transition] = dwell_ms
+				logger.info("Dot %d ppm -> %d ppm: wait %d ms" % (transition + (dwell_ms,)))
+			else:
+				logger.info("Dot %d ppm -> %d ppm: not enough accurate results, keep the default wait" % transition)
+		self.__dwells = dwells
+	
+	def saveToFile(self, filename = 'dwell_table.dat'):
+		file = open(filename, 'w')
+		for (from_ppm, to_ppm), dwell_ms in sorted(self.__dwells.items()):
+			file.write("%d %d %d\n" % (from_ppm, to_ppm, dwell_ms))
+		file.close()
+		logger.info("Saved DUT stabilization wait times into file <%s>" % filename)
+	
+	def loadFromFile(self, filename = 'dwell_table.dat'):
+		dwells = dict()
+		line_re = re.compile('^([0-9]+) ([0-9]+) ([0-9]+)$')
+		file = open(filename, 'r')
+		for line in file.readlines():
+			res = line_re.match(line.rstrip('\n'))
+			if not res:
+				raise ValueError('%s: Invalid file format' % filename)
+			dwells[(int(res.group(1)), int(res.group(2)))] = int(res.group(3))
+		file.close()
+		self.__dwells = dwells
+		logger.info("Loaded DUT stabilization wait times from file <%s> (%d transitions)" % (filename, len(dwells)))
+
 class Co2Jig:
 	__gas_out_delay_ms = 500	# Overpressure avoidance delay
 	__inject_loop_maxtry = 5	# Allow up to 5 gas injections before considering we can't reach the ppm target
 	__valve_min_time_ms = 200	# Minimum opening time for the valve
 	__dut_stab_time_ms = 60000	# Minimum time to wait after gas injection so that the gas concentration is stabilized inside dut sensor
+	__drift_nb_sample = 4		# While waiting, the co2 level drifted if the mean of the last 4 samples is out of the dot tolerance
+	__dut_adaptive_stab = False	# Stop waiting for the DUT ppm stabilization once the DUT readouts are flat
+	__dut_ppm_cmd = None		# DUT firmware cmd reading out the co2 ppm, for the adaptive wait...
+	__dut_ppm_key = None		# ... and the key of the ppm value in its reply: both must be set to enable it
+	__dut_ppm_timeout_ms = 2000
+	__dut_poll_period_ms = 2000	# The DUT readouts are polled every 2 s...
+	__dut_flat_nb_reading = 5	# ... and the last 5 readouts of each DUT...
+	__dut_flat_band_ppm = 15	# ... must be within 15 ppm...
+	__dut_flat_band_ratio = 0.01	# ... or within 1% of their mean
 	__dilution_threshold = 1500 # threshold for decide using N2 or fresh air
+	__dut_tx_echo = False		# Send DUT cmd bytes as soon as they are echoed (instead of 1 byte/ms)
+	__dut_boot_timeout_ms = 20000	# Max. DUT boot time (boot time is ~7 seconds)
+	__dut_nb_shards = 0		# Split the DUT UARTs into this many worker processes (0: all in the main process)
+	__co2meter_record = False	# Record the co2 meter readings into co2meter_record.dat, for StabTuner
+	__ref_concurrent = False	# Calibrate / verify the DUTs with the co2 ppm read by injectForDot(), and record the
+					# co2 meter samples during the DUT measure into ref_window.csv, instead of reading it again
 	
 	def __init__(self):
-		self.__relayboard = RelayBoard()
+		self.__device_cache = DeviceCache()
+		self.__relayboard = RelayBoard(device_cache = self.__device_cache)
 		self.__relayboard.disableAllRelays()
 		self.__co2meter = Co2Meter()
 		self.__itt = JigITT()
+		self.__latency = DutLatencyTracker()
+		self.__last_inject_time = None	# End of the last gas injection: older co2 meter samples are outdated
+		self.__dwell_table = DwellTable()
+		self.__prev_dot_ppm = 0		# Target of the previous dot, 0 before the 1st dot
+		self.__last_dwell = None	# (from ppm, to ppm, wait time ms) of the last dot
 	
 	def injectGas(self, no2, time_ms):
 		relayboard = self.__relayboard
@@ -906,6 +2563,7 @@ class Co2Jig:
 		relayboard.enableRelay(relay_gas_in)
 		sleep(time_ms / 1000.0)
 		relayboard.disableRelay(relay_gas_in)
+		self.__last_inject_time = time()
 		
 		#sleep(self.__gas_out_delay_ms / 1000.0) # Close gas out
 		#relayboard.disableRelay(relayboard.relay_gas_out)
@@ -913,11 +2571,13 @@ class Co2Jig:
 	def injectAir(self,time_ms):  # when co2ppm > 1500, use air to dilute the co2
 		logger.debug("Inject Air for %d ms", time_ms)
 		
-		air_in = self.__relayboard.relay_gas_air
+		relayboard = self.__relayboard
+		air_in = relayboard.relay_gas_air
 		
 		relayboard.enableRelay(air_in)
 		sleep(time_ms / 1000.0)
 		relayboard.disableRelay(air_in)
+		self.__last_inject_time = time()
 	
 	def injectNO2(self, time_ms):
 		logger.debug("Inject NO2 for %d ms", time_ms)
@@ -927,10 +2587,11 @@ class Co2Jig:
 		logger.debug("Inject CO2 for %d ms", time_ms)
 		self.injectGas(False, time_ms)
 
-	def injectForDot(self, dot, cur_ppm = None):
+	def injectForDot(self, dot, cur_ppm = None, dutset = None):
 		'''dot: CalDot object
 		   cur_ppm: current co2 ppm level in the jig
 			    This help to co2 measurement time.
+		   dutset: DutSet polled for the adaptive DUT ppm stabilization wait, if enabled
 		   Inject gas until the co2 level desribed by the CalDot is reached, or "timeout"'''
 		co2meter = self.__co2meter
 		itt = self.__itt
@@ -942,12 +2603,24 @@ class Co2Jig:
 				 % (dot.co2_ppm, dot.co2_ppm_tol))
 
 		if cur_ppm == None:
-			cur_ppm = co2meter.read_ppm()
+			cur_ppm = co2meter.read_ppm(since = self.__last_inject_time)
+		predicted = False	# True if cur_ppm is a forecast of the co2 level after the last injection
 
+		waited = False		# True if the DUTs have waited for the ppm stabilization after the last injection
 		while True:
 			level = dot.refCompareTol(cur_ppm)
 			if level == 0:
-				break
+				if predicted:
+					# Injections are decided on forecasts, the target is checked on a stable co2 level
+					cur_ppm = co2meter.read_ppm(since = self.__last_inject_time)
+					predicted = False
+					continue
+				(waited, drift_ppm) = self.__waitDutStab(dot, post_inject_time, dutset)
+				if drift_ppm is None:
+					break
+				# Correct the co2 level now, and wait for the DUTs again
+				cur_ppm = drift_ppm
+				continue
 
 			try_cnt += 1
 			if try_cnt > maxtry:
@@ -974,22 +2647,138 @@ class Co2Jig:
 					self.injectNO2(no2_time)
 				post_inject_time = time()
 
-			cur_ppm = co2meter.read_ppm()
+			cur_ppm = co2meter.read_ppm(since = self.__last_inject_time, predict_tol_ppm = dot.co2_ppm_tol)
+			predicted = True
 
-		dut_stab_delay = self.__dut_stab_time_ms - (((time()) - post_inject_time) * 1000)
-		logger.debug("(debug) Wait for DUT ppm stabilization: %d ms" % dut_stab_delay)
-		if dut_stab_delay > 0:
-			logger.debug("Wait for DUT ppm stabilization: %d ms" % dut_stab_delay)
-			sleep(dut_stab_delay / 1000)
+		self.__last_dwell = (self.__prev_dot_ppm, dot.co2_ppm, (time() - post_inject_time) * 1000)
+		self.__prev_dot_ppm = dot.co2_ppm
+		if waited:
 			logger.debug("Wait for DUT ppm stabilization: read co2 ppm after DUT stabilization delay")
-			cur_ppm = co2meter.read_ppm(fast_stab=True)
+			cur_ppm = co2meter.read_ppm(fast_stab=True, since = self.__last_inject_time)
 		return cur_ppm
+	
+	def __waitDutStab(self, dot, post_inject_time, dutset = None):
+		'''Wait until __dut_stab_time_ms (or the time of the dot transition in the dwell table) after the
+		   last injection, watching the co2 level.
+		   In adaptive mode, the wait stops as soon as the readouts of all the DUTs of dutset are flat.
+		   Return (waited, drift_ppm): waited is False if there was no time left to wait,
+		   drift_ppm is the co2 level if it drifted out of the dot tolerance (the wait is stopped), or None'''
+		co2meter = self.__co2meter
+		dut_stab_time_ms = self.__dwell_table.getDwellMs(self.__prev_dot_ppm, dot.co2_ppm, self.__dut_stab_time_ms)
+		dut_stab_delay = dut_stab_time_ms - (((time()) - post_inject_time) * 1000)
+		logger.debug("(debug) Wait for DUT ppm stabilization: %d ms" % dut_stab_delay)
+		if dut_stab_delay <= 0:
+			return (False, None)
+		logger.debug("Wait for DUT ppm stabilization: %d ms" % dut_stab_delay)
+		time_start = time()
+		time_end = time_start + dut_stab_delay / 1000.0
+		adaptive = self.__dut_adaptive_stab and (dutset is not None)
+		if adaptive and ((self.__dut_ppm_cmd is None) or (self.__dut_ppm_key is None)):
+			logger.warn("DUT adaptive stabilization wait disabled: no DUT co2 readout cmd configured")
+			adaptive = False
+		next_poll_time = time_start
+		dut_readings = dict()	# last readouts, by DUT name
+		while True:
+			time_left_ms = (time_end - time()) * 1000
+			if time_left_ms <= 0:
+				return (True, None)
+			if adaptive:
+				if time() >= next_poll_time:
+					next_poll_time = time() + self.__dut_poll_period_ms / 1000.0
+					if self.__dutReadingsFlat(dutset, dut_readings):
+						logger.info("DUT ppm readouts flat after %d ms" % ((time() - time_start) * 1000))
+						return (True, None)
+				time_left_ms = min(time_left_ms, (next_poll_time - time()) * 1000)
+			mean_ppm = co2meter.waitMean(self.__drift_nb_sample, time_left_ms, since = self.__last_inject_time)
+			if (mean_ppm is not None) and (dot.refCompareTol(mean_ppm) != 0):
+				logger.info("Co2 level drifted to %d ppm while waiting for DUT ppm stabilization (target %d +-%d ppm)" % (
+						mean_ppm, dot.co2_ppm, dot.co2_ppm_tol))
+				return (True, mean_ppm)
 
+	def sendRefCmd(self, dutset, cmd, timeout_ms, ref_ppm):
+		'''Send cmd, which makes the DUTs measure the co2 level, with ref_ppm as reference.
+		   In concurrent reference mode, the co2 meter samples received while each DUT measures
+		   are recorded next to its result (see DutSetResult.ref_window)
+		   Return the list of DutSetResult'''
+		cmdRes = dutset.sendCmd(cmd, timeout_ms)
+		if not self.__ref_concurrent:
+			return cmdRes
+		
+		file = open('ref_window.csv', 'a', newline='')
+		report = csv.writer(file, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+		date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+		for res in cmdRes:
+			rx_time_ms = res.dut.getRxTime()
+			if (res.cmd_result is None) or (rx_time_ms is None):
+				continue
+			# The DUT measures between the end of the cmd transmit and its reply
+			tx_end_time = res.dut.getTxEndTime()
+			res.ref_window = self.__co2meter.getWindowStats(tx_end_time, tx_end_time + rx_time_ms / 1000.0)
+			if res.ref_window is None:
+				logger.info("No co2 meter sample during the measure of <%s>" % res.dut.getName())
+				continue
+			logger.info("Co2 meter during the measure of <%s>: mean=%0.1f ppm, spread=%0.1f ppm (%d samples)" % (
+					(res.dut.getName(),) + res.ref_window))
+			report.writerow([date, res.dut.getMac() or res.dut.getName(), cmd, ref_ppm,
+					"%0.1f" % res.ref_window[0], "%0.1f" % res.ref_window[1], res.ref_window[2]])
+		file.close()
+		return cmdRes
+	
+	def __dutReadingsFlat(self, dutset, dut_readings):
+		'''Poll the co2 readout of the included DUTs, and add it to dut_readings.
+		   Return True if the last readouts of every DUT are flat. A DUT which fails
+		   the readout is not set as failed, but keeps the wait going'''
+		flat = True
+		for res in dutset.query(self.__dut_ppm_cmd, self.__dut_ppm_timeout_ms):
+			readings = dut_readings.setdefault(res.dut.getName(), deque(maxlen = self.__dut_flat_nb_reading))
+			if (res.cmd_result is None) or (self.__dut_ppm_key not in res.cmd_result.data):
+				flat = False
+				continue
+			try:
+				readings.append(float(res.cmd_result.data[self.__dut_ppm_key]))
+			except ValueError:
+				logger.info("Dut <%s>: invalid co2 readout <%s>" % (res.dut.getName(), res.cmd_result.data[self.__dut_ppm_key]))
+				flat = False
+				continue
+			if len(readings) < self.__dut_flat_nb_reading:
+				flat = False
+				continue
+			band_ppm = max(readings) - min(readings)
+			if (band_ppm > self.__dut_flat_band_ppm) and \
+					(band_ppm > self.__dut_flat_band_ratio * sum(readings) / len(readings)):
+				flat = False
+		return flat
+	
+	def recordDwell(self, dot, dut_errors, filename = 'dwell_history.csv'):
+		'''Append the wait of the last dot, and the verification errors of the DUTs which followed it,
+		   to the wait history (see DwellTable.tuneFromHistory())
+		   dut_errors : list of (Dut, verification error)'''
+		if self.__last_dwell is None:
+			return
+		(from_ppm, to_ppm, dwell_ms) = self.__last_dwell
+		file = open(filename, 'a', newline='')
+		report = csv.writer(file, delimiter='\t', quoting=csv.QUOTE_MINIMAL)
+		date = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+		for dut, error in dut_errors:
+			report.writerow([date, from_ppm, to_ppm, int(dwell_ms), dut.getMac() or dut.getName(),
+					"%0.4f" % error, dot.dut_tol_coef])
+		file.close()
+	
 	def run_test(self, nb_dut, no_cal = False):
+		'''nb_dut : number of DUTs plugged into the jig from left to right,
+		           or None to discover the populated slots'''
 		relayboard = self.__relayboard
 		co2meter = self.__co2meter
 		itt = self.__itt	
-		dutset = DutSet(nb_dut)
+		latency = self.__latency
+		if os.path.isfile('slot_map.dat'):
+			DutSet.loadSlotMap(device_cache = self.__device_cache)
+		dutset = DutSet(nb_dut, rx_mode = 'threads', tx_echo = self.__dut_tx_echo, latency = latency,
+				nb_shards = self.__dut_nb_shards)
+		# Load the response time history before the try: it is saved back whatever happens,
+		# and must not be overwritten by an empty history if the test aborts early
+		if os.path.isfile('dut_latency.dat'):
+			latency.loadFromFile()
 		
 		if no_cal:
 			logger.info("DUT calibration disabled")
@@ -999,6 +2788,8 @@ class Co2Jig:
 			# while True:
 				# pass
 			
+			if self.__co2meter_record:
+				co2meter.setRecordFile('co2meter_record.dat')
 			co2meter.open()
 			relayboard.powerPump(True)
 			relayboard.powerFan(True)
@@ -1006,10 +2797,14 @@ class Co2Jig:
 			#print "ppm=%d" % co2meter.read_ppm()
 			
 			itt.loadFromFile()
+			if os.path.isfile('dwell_table.dat'):
+				self.__dwell_table.loadFromFile()
+			self.__prev_dot_ppm = 0
 			relayboard.powerDutSet(True)
-			logger.info('Duts power-on delay...')
-			sleep(9) # Scale boot time is ~7 seconds
-			dutset.open()
+			if nb_dut is None:
+				dutset.discover(self.__dut_boot_timeout_ms)
+			else:
+				dutset.open(self.__dut_boot_timeout_ms)
 			relayboard.powerFan(True)
 
 			# Disable timelimit
@@ -1027,14 +2822,14 @@ class Co2Jig:
 				for _ in range(2):
 					dutset.sendCmd("co2 calib 100 252 100 252 5 0 0 0.45 1", 30000)
 				
-				# Erase calibration table
-				dutset.sendCmd("perso del_co2cal", 10000)
-				dutset.sendCmd("perso del_co2cal_fast", 10000)
-				dutset.sendCmd("perso del_co2cal_veryfast", 10000)
-				# Erase verification table
-				dutset.sendCmd("perso del_co2verif", 10000)
-				dutset.sendCmd("perso del_co2verif_fast", 10000)
-				dutset.sendCmd("perso del_co2verif_veryfast", 10000)
+				# Erase calibration and verification tables
+				dutset.sendCmds(["perso del_co2cal",
+						"perso del_co2cal_fast",
+						"perso del_co2cal_veryfast",
+						"perso del_co2verif",
+						"perso del_co2verif_fast",
+						"perso del_co2verif_veryfast"],
+						10000)
 
 
 			
@@ -1047,29 +2842,32 @@ class Co2Jig:
 					logger.info("Skip calibration dot %d ppm..." % dot.co2_ppm)
 					continue
 					
-				ref_ppm = self.injectForDot(dot, ref_ppm)
+				ref_ppm = self.injectForDot(dot, ref_ppm, dutset)
 				logger.info("Got %d ppm for target %d +-%d ppm" % (ref_ppm, dot.co2_ppm, dot.co2_ppm_tol))
 					
 				if dot.dut_tol_coef == None:
 					# Calibration : fast
-					ref_ppm = co2meter.read_ppm(fast_stab=True)
+					if not self.__ref_concurrent:
+						ref_ppm = co2meter.read_ppm(fast_stab=True, since = self.__last_inject_time)
 					logger.info("Calibrate DUT for FAST, target %d ppm (ref_ppm=%d)" % (dot.co2_ppm, ref_ppm))
 					cmd = "co2 calib 100 252 100 252 5 %d %d 0.45 1" % (
 							cal_dot_cnt,
 							ref_ppm)
-					dutset.sendCmd(cmd, 30000)
+					self.sendRefCmd(dutset, cmd, 30000, ref_ppm)
 
 					cal_dot_cnt += 1
 				else:
 					# Verification : fast
-					ref_ppm = co2meter.read_ppm(fast_stab=True)
+					if not self.__ref_concurrent:
+						ref_ppm = co2meter.read_ppm(fast_stab=True, since = self.__last_inject_time)
 					logger.info("Verify DUT for FAST, target %d ppm (ref_ppm=%d)" % (dot.co2_ppm, ref_ppm))
 					cmd = "co2 verif %d %d 1" % (
 							verif_dot_cnt,
 							ref_ppm)
-					cmdRes = dutset.sendCmd(cmd, 30000)
+					cmdRes = self.sendRefCmd(dutset, cmd, 30000, ref_ppm)
 					
 					# Check verification 1 : fast
+					dut_errors = list()
 					for res in cmdRes:
 
 						# The result is None if the DUT failed to reply correctly to the cmd
@@ -1078,7 +2876,16 @@ class Co2Jig:
 							logger.info("Verif FAILED on <%s> for FAST: cmd error" % (res.dut.getName()))
 							continue
 
-						dut_ppm = int(res.cmd_result.data['co2_ppm_verif'])
+						if 'co2_ppm_verif' not in res.cmd_result.data:
+							logger.info("Verif FAILED on <%s> for FAST: co2_ppm_verif %s" % (
+									res.dut.getName(),
+									res.cmd_result.errors.get('co2_ppm_verif', "missing")
+									)
+								)
+							res.dut.setPass(False, "FAST verification")
+							continue
+						dut_ppm = res.cmd_result.data['co2_ppm_verif']
+						dut_errors.append((res.dut, dot.dutTolError(ref_ppm, dut_ppm)))
 						if dot.dutMatchTol(ref_ppm, dut_ppm):
 							logger.info("Verif OK on <%s> for FAST: expected %d ppm, got %d ppm (err=%0.3f, max_err +-%0.3f)" % (
 									res.dut.getName(),
@@ -1099,6 +2906,7 @@ class Co2Jig:
 								)
 							# Set DUT as FAILED
 							res.dut.setPass(False, "FAST verification")
+					self.recordDwell(dot, dut_errors)
 
 					verif_dot_cnt += 1
 					
@@ -1126,6 +2934,7 @@ class Co2Jig:
 			dutset.close()
 			co2meter.close()
 			self.saveFactoryReport(dutset.getDuts())
+			latency.saveToFile()
 
 		
 	def run_calib(self):
@@ -1205,11 +3014,11 @@ class Co2Jig:
 				while True:
 					#self.injectNO2(30000)
 					self.injectNO2(20000)
-					ppm = co2meter.read_ppm()
+					ppm = co2meter.read_ppm(since = self.__last_inject_time)
 					if cal_dot_0ppm.refCompareTol(ppm) <= 0:
 						break
 			else:
-				ppm = co2meter.read_ppm()
+				ppm = co2meter.read_ppm(since = self.__last_inject_time)
 			
 			# One measure every co2_step_ms, until we reach the highest
 			# ppm we want to calibrate
@@ -1218,7 +3027,7 @@ class Co2Jig:
 			ppm = 0
 			while ppm < ppm_upper_target:
 				self.injectCO2(co2_step_ms)
-				ppm = co2meter.read_ppm()
+				ppm = co2meter.read_ppm(since = self.__last_inject_time)
 				co2_ppms.append(ppm)
 				
 			# One measure every no2_step_ms, until we reach back ~0ppm
@@ -1233,7 +3042,7 @@ class Co2Jig:
 				else:
 					self.injectNO2(no2_step_ms)
 				
-				ppm = co2meter.read_ppm()
+				ppm = co2meter.read_ppm(since = self.__last_inject_time)
 				no2_ppms.append(ppm)
 				print("ppm=%d, ppm_lower_target=%d" % (ppm, ppm_lower_target))
 			
@@ -1281,16 +3090,30 @@ class Co2Jig:
 		file.close()
 			
 
+def write_without_lf(write, uart_bytes):
+	'''Call write() on each slice of uart_bytes (bytes-like) between "\\n" characters,
+	   instead of building a stripped copy of uart_bytes'''
+	with memoryview(uart_bytes) as view:
+		for piece in re.finditer(b'[^\n]+', view):
+			write(view[piece.start():piece.end()])
+
 def usage():
 	print("Usage:\n")
-	print("run_test <nb_duts> [<-nocal>]\n"	\
+	print("run_test <nb_duts|auto> [<-nocal>]\n"	\
 		"Run DUT test (calibration, and verification)\n" \
-		"	nb_duts: number of DUTs plugged into the jig, fro; left to right (1->16)" \
+		"	nb_duts: number of DUTs plugged into the jig, fro; left to right (1->16, or the number\n" \
+		"	         of slots in slot_map.dat)" \
+		"	         or 'auto' to test the DUTs found in any slot\n" \
 		"	-nocal: disable dut calibration\n")
 	print("run_calib\n" \
 		"	Calibrate the JIG for calve operture times\n")
 	print("relay <list|set|reset> <relay_name>" \
 		"	Control relays (debug)")
+	print("tune_meter [<accuracy_ppm>]\n" \
+		"	Tune the co2 meter stabilization criteria from co2meter_record.dat (default accuracy: 5 ppm)\n")
+	print("tune_dwell [<error_margin>]\n" \
+		"	Tune the DUT stabilization wait times from dwell_history.csv: the DUT verification errors must be\n" \
+		"	lower than error_margin * the verification tolerance (default: 0.5)\n")
 	sys.exit(-1)
 
 def init_logger(log_name):
@@ -1328,7 +3151,7 @@ def main():
 		logger.info(software_version)
 		if argv[1] == 'run_test':
 			skipcal = False
-			nb_dut = int(argv[2])
+			nb_dut = None if argv[2] == 'auto' else int(argv[2])
 			if len(argv) >= 4:
 				print("argv[2] = <%s>" % argv[2])
 				if argv[3] == '-nocal':
@@ -1363,6 +3186,22 @@ def main():
 				usage()
 			sys.exit(0)
 			
+		elif argv[1] == 'tune_meter':
+			accuracy_ppm = float(argv[2]) if len(argv) >= 3 else 5
+			tuner = StabTuner()
+			tuner.loadRecords()
+			profile = tuner.tune(accuracy_ppm)
+			if profile is None:
+				logger.info("No stabilization criteria reads the recorded injections within %0.1f ppm" % accuracy_ppm)
+				return -1
+			StabTuner.saveProfile(profile)
+			
+		elif argv[1] == 'tune_dwell':
+			error_margin = float(argv[2]) if len(argv) >= 3 else 0.5
+			dwell_table = DwellTable()
+			dwell_table.tuneFromHistory(error_margin = error_margin)
+			dwell_table.saveToFile()
+			
 		elif argv[1] == 'co2':
 			co2meter = Co2Meter()
 			co2meter.open()